@@ -4,6 +4,7 @@ import zmq
 import logging
 import time
 import json
+import socket
 import subprocess
 import multiprocessing as mp
 from rc_client import RC
@@ -21,19 +22,30 @@ logger.addHandler(client_error_handler)
 
 PING_INTERVAL = 6 # s
 POLLER_COMMANDS_TIMEOUT = 100 # ms
+EVPRODUCER_START_TIME = 2 # s, the evproducer must still be running after this time
 
 context = zmq.Context()
 rc = RC()
 hv = HV()
 
 
+def evproducer_running(pid):
+    """True if the process pid exists and has not exited (zombies included)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] not in "ZX"
+    except (OSError, IndexError):
+        return False
+
+
 class Client:
     def __init__(self, port=8001, hv_port="/dev/ttyPS1"):
         self.port = port
         self.hv_port = hv_port
         self.client = None
         self.server_ip = "172.16.24.107"
-        self.client_id = b"Client"
+        # The identity must differ between the multiPMTs connected to the same server
+        self.client_id = f"Client-{socket.gethostname()}".encode()
 
     def send_json(self, data):
         try:
@@ -79,8 +91,9 @@ class Client:
                 if message == b"Alive":
                     logger.info("Server responded. Connection established")
                     self.client.send(b"Connection successful")
-                    evproducer = self.client.recv()
-                    if evproducer == b"EV":
+                    # The server adds the port of the receiver assigned to this multiPMT
+                    evproducer = self.client.recv_multipart()
+                    if evproducer[0] == b"EV":
                         rc.write(1, 127)
                         time.sleep(0.1)
                         rc.write(0, 127)
@@ -95,10 +108,17 @@ class Client:
                         time.sleep(0.1)
                         hv.set_hv_init_configuration(channels="all", port="/dev/ttyPS1", voltage_set=1200, threshold_set=100, limit_trip_time=2, limit_voltage=100, limit_current=5, limit_temperature=50, rate_up=25, rate_down=25)
                         hv.power_on(channels="all", port="/dev/ttyPS1")
-                        exec_command = ["/root/evproducer.sh"]
+                        exec_command = ["/root/evproducer.sh"] + [part.decode() for part in evproducer[1:2]]
                         logger.info(f"Executing evproducer with: {exec_command}")
-                        process = subprocess.Popen(exec_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                        logger.info("Evproducer has started successfully")
+                        # The script prints the PID of the evproducer, which must still be running after a while
+                        result = subprocess.run(exec_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                        evproducer_pid = result.stdout.decode().strip()
+                        time.sleep(EVPRODUCER_START_TIME)
+                        if not evproducer_running(evproducer_pid):
+                            logger.critical(f"Evproducer exited right after the start: {exec_command}")
+                            self.client.send(b"EV Failed")
+                            return False
+                        logger.info(f"Evproducer has started successfully with PID {evproducer_pid}")
                         self.client.send(b"EV Success")
                         connected = True
                         return True
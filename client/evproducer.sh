@@ -1,3 +1,6 @@
 #!/bin/bash
-evproducer_pid=$(nohup /opt/mpmt-readout/evproducer --host 172.16.24.107 --disable-rc > /dev/null 2>&1 & echo $!)
+# Optional argument: the port of the receiver assigned to this multiPMT by the server, when it is not the default one
+# Prints the PID of the evproducer
+evproducer_pid=$(nohup /opt/mpmt-readout/evproducer --host 172.16.24.107 ${1:+--port $1} --disable-rc > /dev/null 2>&1 & echo $!)
+echo $evproducer_pid
 exit
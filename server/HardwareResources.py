@@ -2,7 +2,7 @@ import logging
 import json
 import zmq
 from typing import List, Callable, Union
-import data_processing
+import boards
 import time
 
 logger = logging.getLogger("Server")
@@ -274,9 +274,11 @@ def HVCalibration(socket:zmq.Socket, clients: List[bytes], port:str, channels:Un
 ######################################
 
 
-def DMACommunication(socket:zmq.Socket, clients: List[bytes], charge:data_processing.DataProcess, suffix:str, flag_acquisition:str, run_id:Union[str, None], 
-                     timer:int, batch:int, output_func: Callable[[str], None]) -> None:
-    
+def DMACommunication(socket:zmq.Socket, clients: List[bytes], charge:boards.BoardReceivers, suffix:str, flag_acquisition:str, run_id:Union[str, None], 
+                     timer:int, batch:int, output_func: Callable[[str], None], output:str = "npy", flush_policy = None,
+                     coincidence_window:Union[float, None] = None, coincidence_groups:bool = False, check_crc:bool = False) -> Union[dict, None]:
+    """Runs an acquisition on all the boards. Returns the path of the acquisition file of every board"""
+
     if timer is not None and timer < 10:
         logger.critical("Select a timer value greater than 10 seconds")
         return
@@ -306,25 +308,48 @@ def DMACommunication(socket:zmq.Socket, clients: List[bytes], charge:data_proces
     ######################
 
     ######################
-    output_func("Removing old data in the FIFO (30 seconds wait)")
+    output_func("Removing old data in the FIFO (up to 30 seconds)")
     try: 
-        charge.flush_fifo(duration=30)
+        for board, fifo_stats in charge.flush_fifo(duration=30).items():
+            if fifo_stats:
+                output_func(f"Emptied FIFO of {board}: {fifo_stats['bytes']} bytes drained in {fifo_stats['seconds']:.1f} s ({fifo_stats['reason']})")
     except Exception as e:
         output_func(f"Some problems occured empting the FIFO:{e}")
 
-    output_func("Emptied FIFO. Waiting 3 seconds to start the acquisition")
-    time.sleep(3)
+    time.sleep(0.1)
     ######################
 
     output_func(f"Acquisition started. Waiting for {timer} seconds.")
+    paths = None
     try: 
-        charge.run(duration=timer, suffix=suffix, flag_acq=flag_acquisition, run_id=run_id, number = batch)
+        paths = charge.run(duration=timer, suffix=suffix, flag_acq=flag_acquisition, run_id=run_id, number = batch, output = output, flush_policy = flush_policy,
+                   coincidence_window = coincidence_window, coincidence_groups = coincidence_groups, check_crc = check_crc)
     except Exception as e:
         output_func(f"Some problems occured starting or managing the acquisition:{e}")
 
     output_func("Acquisition time has expired")
+    for board, run_stats in charge.run_stats.items():
+        ring_stats = run_stats.get("ring")
+        if ring_stats:
+            output_func(f"{board} ring buffer: maximum occupancy {100 * ring_stats['high_water'] / ring_stats['capacity']:.1f}%, "
+                        f"{ring_stats['frames_dropped']} frames dropped out of {ring_stats['frames_written'] + ring_stats['frames_dropped']}")
+        rejected_stats = run_stats.get("rejected")
+        if check_crc and rejected_stats:
+            if rejected_stats["crc_checked"]:
+                output_func(f"{board} CRC errors per channel: {rejected_stats['crc_errors']}")
+            else:
+                output_func(f"{board} CRC not checked: most of the first events fail it, the CRC definition does not match the front-end")
+        timestamp_stats = run_stats.get("timestamps")
+        if timestamp_stats and (timestamp_stats["coarse_overflow"] or timestamp_stats["backwards"]):
+            output_func(f"{board} timestamps do not fit the coarse time mode {timestamp_stats['coarse_mode']}: coarse times of a second or more "
+                        f"per channel {timestamp_stats['coarse_overflow']}, timestamps going back per channel {timestamp_stats['backwards']}")
+        coincidence_stats = run_stats.get("coincidences")
+        if coincidence_stats:
+            output_func(f"{board} coincidences within {coincidence_stats['window']} ns: {coincidence_stats['coincidences']}, "
+                        f"clusters per multiplicity {coincidence_stats['multiplicity']}")
 
     time.sleep(0.1)
     RCWrite(socket=socket, clients=clients, addr=19, value=0, output_func=output_func)  
+    return paths
 
 
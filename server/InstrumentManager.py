@@ -1,66 +1,183 @@
 from instruments import Wheels, Polarizer
-from typing import Callable
+from simulated_instruments import SimulatedPolarizer, SimulatedWheels
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Optional
+import json
 import logging
+import threading
+import time
 
 logger = logging.getLogger("Server")
 
+#Dictionary of the optical instruments => "instrument" : (class, serial port)
+instrument_ports = {
+    "near_wheel" : (Wheels, "/dev/ttyUSB1"),
+    "far_wheel" : (Wheels, "/dev/ttyUSB2"),
+    "polarizer" : (Polarizer, "/dev/ttyUSB0"),
+}
+
+#Dictionary of the backends of the instruments => "backend" : {"instrument" : class}
+instrument_backends = {
+    "hardware" : {"near_wheel" : Wheels, "far_wheel" : Wheels, "polarizer" : Polarizer},
+    "simulated" : {"near_wheel" : SimulatedWheels, "far_wheel" : SimulatedWheels, "polarizer" : SimulatedPolarizer},
+}
+
+INSTRUMENTS_CONFIG_PATH = Path("/swgo") / "multiPMT" / "instruments.json"
+
+
+def load_instrument_ports(path=INSTRUMENTS_CONFIG_PATH):
+    """
+    The instrument table with the backends selected in path, like
+    {"near_wheel": {"backend": "simulated", "per_position": 0.3, "move_failure": 0.01}}: the
+    other keys are passed to the backend class. The instruments not in path use the hardware.
+    """
+    ports = dict(instrument_ports)
+    path = Path(path)
+    if path.exists():
+        with open(path) as f:
+            config = json.load(f)
+        for name, options in config.items():
+            options = dict(options)
+            backend = options.pop("backend", "hardware")
+            port = options.pop("port", instrument_ports[name][1])
+            ports[name] = (partial(instrument_backends[backend][name], **options), port)
+            logger.info(f"{name} on {port} uses the {backend} backend")
+    return ports
+
 
 class InstrumentsManager:
-    def __init__(self, output_func: Callable[[str], None]):
+    def __init__(self, output_func: Callable[[str], None], ports: Optional[dict] = None):
         """
         Class dedicated to the management of optical instruments: Polarizer and Wheels
+
+        The instruments are opened the first time they are used and kept open, with their identity
+        and last known position, until close() is called. Before every use a cheap health check
+        (a position query) is done: only an instrument that fails it is closed and opened again.
+
+        ports is the table of the instruments like instrument_ports, by default the one configured
+        in INSTRUMENTS_CONFIG_PATH (see load_instrument_ports).
         """
-        self.near_wheel = None
-        self.far_wheel = None
-        self.polarizer = None
         self.output = output_func
+        self.ports = load_instrument_ports() if ports is None else ports
+        self.devices = {}
+        self.info = {}
+        self.positions = {}
 
-    def init_wheels(self, near_wheel_pos:int, far_wheel_pos:int) -> None:
+    @property
+    def near_wheel(self):
+        return self.devices.get("near_wheel")
+
+    @property
+    def far_wheel(self):
+        return self.devices.get("far_wheel")
+
+    @property
+    def polarizer(self):
+        return self.devices.get("polarizer")
+
+    def device(self, name:str):
         """
-        Wheels initialisation and position settings
+        Returns the open instrument, after checking that it still answers. The instrument is
+        opened, or opened again after a failed check, and its identity is read only in that case.
         """
+        device = self.devices.get(name)
+        if device is not None:
+            try:
+                self.positions[name] = device.check()
+                return device
+            except Exception as e:
+                logger.warning(f"Health check of the {name} failed, opening it again: {e}")
+                self.release(name)
+
+        device_class, port = self.ports[name]
+        device = device_class(port)
         try:
-            # Initialize near wheel
-            self.near_wheel = Wheels('/dev/ttyUSB1')
-            near_id, positions, current_pos = self.near_wheel.device_info()
-            self.output(f"Near wheel ID: {near_id}, Positions: {positions}, Current: {current_pos}")
-            
-            # Initialize far wheel
-            self.far_wheel = Wheels('/dev/ttyUSB2')
-            far_id, positions, current_pos = self.far_wheel.device_info()
-            self.output(f"Far wheel ID: {far_id}, Positions: {positions}, Current: {current_pos}")
-            
-            # Set positions
-            self.near_wheel.go_to_position(near_wheel_pos)
-            self.output(f"Near wheel moved to position {near_wheel_pos}")
-            
-            self.far_wheel.go_to_position(far_wheel_pos)
-            self.output(f"Far wheel moved to position {far_wheel_pos}")
+            self.info[name] = device.device_info()
+            self.positions[name] = device.check()
+        except Exception:
+            device.close()
+            raise
+        self.devices[name] = device
+        self.output(f"Opened {name} on {port}: {self.info[name]}")
+        return device
 
+    def move(self, name:str, position) -> None:
+        """Moves an instrument, unless it is already in position. On errors the instrument is released"""
+        device = self.device(name)
+        if self.positions.get(name) == position:
+            return
+        try:
+            device.go_to_position(position)
+            self.positions[name] = position
+        except Exception:
+            self.release(name)
+            raise
+
+    def move_all(self, positions:Dict[str, float]) -> Dict[str, float]:
+        """
+        Moves several instruments at the same time, one thread each, and returns when all of them
+        have settled. Returns the move time of every instrument in seconds. The first error is
+        raised again once all the moves are over.
+        """
+        times = {}
+        errors = {}
+
+        def move(name, position):
+            start = time.perf_counter()
+            try:
+                self.move(name, position)
+            except Exception as e:
+                errors[name] = e
+            finally:
+                times[name] = time.perf_counter() - start
+
+        threads = [threading.Thread(target=move, args=(name, position), name=f"move-{name}") for name, position in positions.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise next(iter(errors.values()))
+        return {name: times[name] for name in positions}
+
+    def configure(self, near_wheel:Optional[int] = None, far_wheel:Optional[int] = None, polarizer:Optional[float] = None) -> Optional[Dict[str, float]]:
+        """
+        Moves the given instruments to their positions concurrently: a configuration change costs
+        the slowest move instead of the sum of all of them. Returns the move time of every instrument.
+        """
+        positions = {"near_wheel": near_wheel, "far_wheel": far_wheel, "polarizer": None if polarizer is None else float(polarizer)}
+        positions = {name: position for name, position in positions.items() if position is not None}
+        start = time.perf_counter()
+        try:
+            times = self.move_all(positions)
         except Exception as e:
-            logger.error(f"Error during wheel initialization: {e}")
+            logger.error(f"Error moving the instruments to {positions}: {e}")
             self.output(f"Error: {e}")
-            
-            if self.near_wheel:
-                self.near_wheel.close()
-            if self.far_wheel:
-                self.far_wheel.close()
+            return None
+        moves = ", ".join(f"{name} to {positions[name]} in {seconds:.2f} s" for name, seconds in times.items())
+        self.output(f"Moved {moves} (total {time.perf_counter() - start:.2f} s)")
+        return times
+
+    def release(self, name:str) -> None:
+        device = self.devices.pop(name, None)
+        self.positions.pop(name, None)
+        if device:
+            device.close()
+
+    def close(self) -> None:
+        """Closes all the open instruments"""
+        for name in list(self.devices):
+            self.release(name)
+
+    def init_wheels(self, near_wheel_pos:int, far_wheel_pos:int) -> None:
+        """
+        Wheels initialisation and position settings, both wheels at the same time
+        """
+        self.configure(near_wheel=near_wheel_pos, far_wheel=far_wheel_pos)
 
     def init_polarizer(self, pol_position:int) -> None:
         """
         Polarizer initialisation and position settings
         """
-        try:
-            #Initialise Polarizer
-            self.polarizer = Polarizer('/dev/ttyUSB0')
-            pol_name, pol_pos, pol_para = self.polarizer.device_info()
-            self.output(f"Polarizer name: {pol_name}, Position: {pol_pos}, Parameters: {pol_para}")
-            
-            #Set Polarizer Position
-            self.polarizer.go_to_position(pol_position)
-            self.output(f"Polarizer moved to position {pol_position}")
-        except Exception as e:
-            logger.error(f"Error during polarizer initialization: {e}")
-            self.output(f"Error: {e}")
-            if self.polarizer:
-                self.polarizer.close()
\ No newline at end of file
+        self.configure(polarizer=pol_position)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Offline decoding of a whole batch of acquisitions, one worker process per core.
+
+Every raw capture file (.cap) found under the batch directory is decoded and every legacy CSV
+acquisition is converted to the .npy format. Captures whose .npy output is newer than the capture
+are skipped, as are CSV files that already have a .npy file next to them.
+
+Usage: python batch_decode.py /swgo/multiPMT/calibration/batch_N/ [--workers 8] [--force]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from capture import CaptureWriter, decode_capture
+from writers import NpyEventWriter, import_csv, read_events
+
+
+def find_acquisitions(batch_folder):
+    """Returns the capture files and the legacy CSV files found under the batch folder"""
+    batch_folder = Path(batch_folder)
+    captures = sorted(batch_folder.rglob(f"*.{CaptureWriter.extension}"))
+    csv_files = sorted(batch_folder.rglob("*.csv"))
+    return captures + csv_files
+
+
+def is_up_to_date(source, output):
+    if not output.exists():
+        return False
+    if source.suffix == ".csv":
+        # A .npy file next to a CSV is either its conversion or the file the CSV was exported from
+        return True
+    return output.stat().st_mtime >= source.stat().st_mtime
+
+
+def process_acquisition(source, force=False):
+    """
+    Decodes or converts a single acquisition. Runs in a worker process.
+    Returns (source, status, number of events, input bytes, seconds).
+    """
+    source = Path(source)
+    output = source.with_suffix(f".{NpyEventWriter.extension}")
+    if not force and is_up_to_date(source, output):
+        return source, "skipped", 0, 0, 0.0
+
+    start = time.perf_counter()
+    try:
+        if source.suffix == f".{CaptureWriter.extension}":
+            decode_capture(source, output)
+        else:
+            import_csv(source, output)
+    except Exception as e:
+        return source, f"failed: {e}", 0, 0, time.perf_counter() - start
+    return source, "done", len(read_events(output)), source.stat().st_size, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode all the acquisitions of a batch in parallel")
+    parser.add_argument("batch_folder", type=str, help="The batch folder, e.g. /swgo/multiPMT/calibration/batch_1/")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: one per core)")
+    parser.add_argument("--force", action="store_true", help="Process also the files whose outputs are up to date")
+    args = parser.parse_args()
+
+    sources = find_acquisitions(args.batch_folder)
+    print(f"Found {len(sources)} acquisitions in {args.batch_folder}, using {args.workers} workers")
+
+    events = 0
+    nbytes = 0
+    counts = {"done": 0, "skipped": 0, "failed": 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(process_acquisition, source, args.force) for source in sources]
+        for future in as_completed(futures):
+            source, status, n_events, n_bytes, seconds = future.result()
+            counts[status.split(":")[0]] += 1
+            events += n_events
+            nbytes += n_bytes
+            if status != "skipped":
+                print(f"{status:<8} {source} ({n_events} events in {seconds:.2f} s)")
+    elapsed = time.perf_counter() - start
+
+    print(f"Processed {counts['done']} files, skipped {counts['skipped']}, failed {counts['failed']} in {elapsed:.1f} s")
+    if elapsed > 0 and counts["done"]:
+        print(f"Throughput: {events / elapsed:.0f} events/s, {nbytes / elapsed / 1e6:.1f} MB/s of input")
+
+
+if __name__ == "__main__":
+    main()
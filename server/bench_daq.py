@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+End-to-end benchmark of the DAQ: a synthetic evproducer (see evproducer_sim.py) sends events to
+DataProcess.run at increasing rates, and for every rate the benchmark reports the events decoded
+per second, the frames dropped, the latency of the decoded blocks and the CPU time of every stage.
+Everything runs on this machine, no board is needed. The acquisition files are written to a
+temporary folder and removed.
+
+The rate is ramped until the decoded rate falls below the sent rate or frames are dropped,
+which gives the highest sustainable event rate of the machine. With --decode-workers > 1 the
+decoding runs in the worker processes and its CPU time is not part of the decode stage.
+Usage: python bench_daq.py --rates 1e5,3e5,1e6,3e6 --duration 10 --decode-workers 1
+"""
+import argparse
+import multiprocessing as mp
+import tempfile
+import time
+
+from data_processing import DataProcess
+from evproducer_sim import SyntheticProducer, parse_channels
+
+
+# Share of the sent events that must be decoded for a rate to be sustained
+SUSTAINED_FRACTION = 0.99
+
+
+def produce(port, rate, frame_events, channel_weights, duration, results):
+    producer = SyntheticProducer(port=port, rate=rate, frame_events=frame_events, channel_weights=channel_weights)
+    results.put(producer.run(duration))
+
+
+def bench_rate(daq, folder, rate, duration, frame_events=1024, channel_weights=None, output="npy", drain=2.0):
+    """Runs the producer at one rate against the receiver. Returns the measurements"""
+    results = mp.Queue()
+    producer = mp.Process(target=produce, args=(daq.port, rate, frame_events, channel_weights, duration, results))
+    producer.start()
+    start = time.time()
+    # The receiver keeps going a little longer than the producer to collect the frames in flight
+    daq.run(duration=duration + drain, suffix=f"bench_{rate:.0f}", folder=folder, output=output)
+    sent = results.get()
+    producer.join()
+    stats = daq.run_stats
+    ring = stats.get("ring", {})
+    seconds = sent["seconds"]
+    stages = {"producer": sent["cpu_time"], "receive": stats["receive_time"]}
+    stages.update(stats["stage_time"])
+    return {
+        "rate": rate,
+        "sent": sent["events"] / seconds,
+        "decoded": stats["events"] / seconds,
+        "lost_events": sent["events"] - stats["events"],
+        "frames_dropped": sent["frames_dropped"] + ring.get("frames_dropped", 0),
+        "latency": stats["latency"],
+        # Fraction of one core used by every stage
+        "cpu": {stage: cpu / seconds for stage, cpu in stages.items()},
+        "wall": time.time() - start,
+    }
+
+
+def sustained(result):
+    return result["frames_dropped"] == 0 and result["decoded"] >= SUSTAINED_FRACTION * result["rate"]
+
+
+def report(result):
+    latency = result["latency"]
+    cpu = " ".join(f"{stage}={100 * share:.0f}%" for stage, share in result["cpu"].items() if share >= 0.005)
+    print(f"{result['rate']:>12.0f}{result['sent']:>12.0f}{result['decoded']:>12.0f}{result['frames_dropped']:>9}"
+          f"{1e3 * latency.get('p50', float('nan')):>10.1f}{1e3 * latency.get('p99', float('nan')):>10.1f}  {cpu}")
+    if result["sent"] < SUSTAINED_FRACTION * result["rate"]:
+        print(f"{'':>12}The producer could not keep up with the rate: the latency includes its delay. Try larger frames")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the DAQ with a synthetic evproducer")
+    parser.add_argument("--rates", type=str, default="1e5,3e5,1e6,3e6", help="Comma separated event rates to try, in events/s")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of sending at every rate")
+    parser.add_argument("--frame-events", type=int, default=1024, help="Events per frame")
+    parser.add_argument("--channels", type=str, default=None, help="Channel mix as channel[:weight],... (default: all channels equally)")
+    parser.add_argument("--decode-workers", type=int, default=1, help="Decoder processes of the consumer")
+    parser.add_argument("--output", type=str, default="npy", help="The output format of the acquisition files")
+    parser.add_argument("--port", type=int, default=5555, help="The port of the receiver")
+    parser.add_argument("--keep-going", action="store_true", help="Try all the rates, also after one is not sustained")
+    args = parser.parse_args()
+
+    channel_weights = parse_channels(args.channels) if args.channels else None
+    daq = DataProcess(port=args.port, persistent=True, decode_workers=args.decode_workers)
+    daq.start_connection()
+    print(f"{'rate':>12}{'sent/s':>12}{'decoded/s':>12}{'dropped':>9}{'p50 ms':>10}{'p99 ms':>10}  CPU per stage (% of a core)")
+    best = None
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench_daq_") as folder:
+            for rate in (float(rate) for rate in args.rates.split(",")):
+                result = bench_rate(daq, folder, rate, args.duration, args.frame_events, channel_weights, args.output)
+                report(result)
+                if sustained(result):
+                    best = result
+                elif not args.keep_going:
+                    break
+    finally:
+        daq.close()
+    if best:
+        print(f"Highest sustained rate: {best['decoded']:.0f} events/s")
+    else:
+        print("No rate was sustained")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Micro-benchmark and bit-exact equivalence check of the event decoders.
+
+Millions of random events and a set of edge cases (single bits set or cleared, all zeros, all
+ones, maximum field values) are decoded by DataProcess.process_data, the reference, and by every
+decoder in the decoders table. Every field must be identical to the reference, the timestamp
+must be coarse time * TDC_BINS + TDC time. For every decoder the CPU time per event and the
+memory allocated per event (peak traced by tracemalloc) are reported, so that a new decoder can be
+added to the table and compared on numbers.
+
+The exit status is 1 if any decoder differs from the reference.
+Usage: python bench_decoder.py --events 2000000 --frame-events 1024
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from data_processing import DataProcess
+from decode_pool import ShardedDecoder
+from decoder import EVENT_WORDS, TDC_BINS, decode_frame, decode_words
+from evproducer_sim import encode_events
+from histograms import N_CHANNELS
+
+
+# Columns written by process_data, in order, with the corresponding EVENT_DTYPE field
+REFERENCE_FIELDS = ["channel", "unix_time_16", "coarse_time", "tdc_time", "tot_time", "tdc_trigger_end", "energy", "crc"]
+
+
+class RowCollector:
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+
+def edge_case_events():
+    """Events that exercise every bit and the limits of every field"""
+    cases = [np.zeros(EVENT_WORDS, dtype=np.uint16), np.full(EVENT_WORDS, 0xFFFF, dtype=np.uint16),
+             np.tile(np.array([0xAAAA, 0x5555], dtype=np.uint16), EVENT_WORDS // 2),
+             np.tile(np.array([0x5555, 0xAAAA], dtype=np.uint16), EVENT_WORDS // 2)]
+    bits = np.eye(EVENT_WORDS * 16, dtype=np.uint8).reshape(-1, EVENT_WORDS, 16)
+    single_bits = np.packbits(bits, axis=-1).view(">u2").reshape(-1, EVENT_WORDS).astype(np.uint16)
+    maxima = encode_events(channel=[31, 0, 0, 0, 0, 0, 0], unix_time=[0, 0xFFFF, 0, 0, 0, 0, 0], coarse_time=[0, 0, (1 << 28) - 1, 0, 0, 0, 0],
+                           tdc_time=[0, 0, 0, 31, 0, 0, 0], tot_time=[0, 0, 0, 0, 63, 0, 0], tdc_trigger_end=[0, 0, 0, 0, 0, 31, 0],
+                           energy=[0, 0, 0, 0, 0, 0, (1 << 14) - 1], crc=[0, 0, 0, 0, 0, 0, 0xFF])
+    return np.concatenate([np.array(cases), single_bits, 0xFFFF ^ single_bits, maxima])
+
+
+def make_events(n_events, seed=0):
+    """The edge cases followed by random events, as an (N, 8) uint16 array"""
+    edges = edge_case_events()
+    rng = np.random.default_rng(seed)
+    return np.concatenate([edges, rng.integers(0, 1 << 16, size=(max(0, n_events - len(edges)), EVENT_WORDS), dtype=np.uint16)])
+
+
+def reference_decode(words):
+    """Decodes every event with DataProcess.process_data, from the hex strings of the legacy receiver"""
+    processor = DataProcess.__new__(DataProcess)
+    collector = RowCollector()
+    for event in words.tolist():
+        processor.process_data(" ".join(f"{word:04x}" for word in event), collector)
+    return np.array(collector.rows, dtype=np.int64).reshape(-1, len(REFERENCE_FIELDS))
+
+
+def frames_of(words, frame_events):
+    return [words[start:start + frame_events] for start in range(0, len(words), frame_events)]
+
+
+def decode_words_frames(frames):
+    return [decode_words(frame) for frame in frames]
+
+
+def decode_frame_frames(frames):
+    # The bytes are taken outside of the timing in the real receiver too
+    return [decode_frame(frame.data) for frame in frames]
+
+
+def pool_frames(frames, workers=2, block_events=128 * 1024):
+    """The decoder processes used while recording, on blocks of frames, without CRC check"""
+    pool = ShardedDecoder(workers)
+    block = []
+    size = 0
+    blocks = []
+    for frame in frames:
+        block.append(frame.tobytes())
+        size += len(frame)
+        if size >= block_events:
+            pool.submit(block, check_crc=False)
+            blocks.extend(events for events, _ in pool.ready())
+            block = []
+            size = 0
+    if block:
+        pool.submit(block, check_crc=False)
+    blocks.extend(events for events, _ in pool.close())
+    return blocks
+
+
+# Decoders compared with the reference => "name" : (function of a list of frames, keeps only the valid channels)
+decoders = {
+    "decode_words": (decode_words_frames, False),
+    "decode_frame": (decode_frame_frames, False),
+    "pool": (pool_frames, True),
+}
+
+
+def compare(name, events, words, reference, valid_channels):
+    """Checks every field against the reference. Returns the number of differing events"""
+    if valid_channels:
+        kept = reference[:, 0] < N_CHANNELS
+        words = words[kept]
+        reference = reference[kept]
+    if len(events) != len(reference):
+        print(f"{name}: {len(events)} events decoded, {len(reference)} expected")
+        return max(1, abs(len(events) - len(reference)))
+    differing = np.zeros(len(events), dtype=bool)
+    for column, field in enumerate(REFERENCE_FIELDS):
+        differing |= events[field].astype(np.int64) != reference[:, column]
+    timestamp = reference[:, REFERENCE_FIELDS.index("coarse_time")] * TDC_BINS + reference[:, REFERENCE_FIELDS.index("tdc_time")]
+    differing |= events["timestamp"].astype(np.int64) != timestamp
+    bad = np.flatnonzero(differing)
+    if len(bad):
+        first = int(bad[0])
+        print(f"{name}: {len(bad)} events differ. First one #{first}, words {' '.join(f'{word:04x}' for word in words[first])}")
+        print(f"    expected {dict(zip(REFERENCE_FIELDS, reference[first].tolist()))}")
+        print(f"    decoded  {dict(zip(REFERENCE_FIELDS, [int(events[field][first]) for field in REFERENCE_FIELDS]))}")
+    return len(bad)
+
+
+def cpu_time():
+    """CPU time of this process and of its terminated children, like the decoder processes"""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+def measure(function, frames, trace):
+    if trace:
+        tracemalloc.start()
+    cpu_start = cpu_time()
+    wall_start = time.perf_counter()
+    blocks = function(frames)
+    cpu = cpu_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    peak = 0
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return blocks, cpu, wall, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark and equivalence check of the event decoders")
+    parser.add_argument("--events", type=int, default=2_000_000, help="Number of events (edge cases included)")
+    parser.add_argument("--frame-events", type=int, default=1024, help="Events per frame handed to the decoders")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random events")
+    args = parser.parse_args()
+
+    words = make_events(args.events, args.seed)
+    cpu_start = cpu_time()
+    wall_start = time.perf_counter()
+    reference = reference_decode(words)
+    cpu = cpu_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    frames = frames_of(words, args.frame_events)
+
+    print(f"{len(words)} events ({len(edge_case_events())} edge cases) in frames of {args.frame_events} events")
+    print(f"{'decoder':<16}{'events':>10}{'ns/event (CPU)':>16}{'events/s':>14}{'alloc B/event':>15}  result")
+    print(f"{'process_data':<16}{len(words):>10}{1e9 * cpu / len(words):>16.1f}{len(words) / wall:>14.0f}{'':>15}  reference")
+    failures = 0
+    for name, (function, valid_channels) in decoders.items():
+        blocks, cpu, wall, _ = measure(function, frames, trace=False)
+        # The allocations are traced on a separate run, tracemalloc slows the decoding down
+        traced_frames = frames[:max(1, len(frames) // 10)]
+        _, _, _, peak = measure(function, traced_frames, trace=True)
+        traced = sum(len(frame) for frame in traced_frames)
+        events = np.concatenate(blocks)
+        differing = compare(name, events, words, reference, valid_channels)
+        failures += bool(differing)
+        result = "identical" if not differing else f"{differing} differ"
+        if valid_channels:
+            result += f" ({len(words) - len(events)} events of channels >= {N_CHANNELS} rejected)"
+        # The rates are per input event, also for the decoders that reject some events
+        print(f"{name:<16}{len(words):>10}{1e9 * cpu / len(words):>16.1f}{len(words) / wall:>14.0f}{peak / traced:>15.1f}  {result}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Check of the FIFO drain (DataProcess.flush_fifo) against a synthetic evproducer (see
+evproducer_sim.py): a backlog is sent at a high rate, followed by live events at the trigger rate,
+and the time the drain takes to stop is compared with the expected one.
+
+The live rate is learned from a short acquisition first, as the receiver does between the steps
+of a measurement, except in the first scenario. The exit status is 1 if any scenario stops outside
+its expected range.
+Usage: python bench_drain.py --live-rate 1e4 --backlog-factor 10
+"""
+import argparse
+import sys
+import tempfile
+import threading
+
+from data_processing import DataProcess
+from evproducer_sim import SyntheticProducer
+
+
+def send(port, phases, frame_events):
+    """Sends the phases (events/s, seconds) one after the other"""
+    for rate, seconds in phases:
+        SyntheticProducer(port=port, rate=rate, frame_events=frame_events).run(seconds)
+
+
+def drain(daq, phases, frame_events, settle_time):
+    """Runs the drain while the phases are sent. Returns the FIFO stats"""
+    sender = threading.Thread(target=send, args=(daq.port, phases, frame_events))
+    sender.start()
+    try:
+        return daq.flush_fifo(duration=30, settle_time=settle_time)
+    finally:
+        sender.join()
+
+
+def discard_leftovers(daq):
+    """Empties the socket of the frames sent after the end of a step, without a live rate to wait for"""
+    live_rate = daq.live_rate
+    daq.live_rate = None
+    daq.flush_fifo(duration=5, idle=0.3)
+    daq.live_rate = live_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check of the FIFO drain with a synthetic evproducer")
+    parser.add_argument("--live-rate", type=float, default=1e4, help="Events per second of the live triggers")
+    parser.add_argument("--backlog-factor", type=float, default=10, help="Rate of the backlog over the live rate")
+    parser.add_argument("--frame-events", type=int, default=256, help="Events per frame")
+    parser.add_argument("--settle-time", type=float, default=10.0, help="settle_time of the drain")
+    parser.add_argument("--port", type=int, default=5555, help="The port of the receiver")
+    args = parser.parse_args()
+
+    live = args.live_rate
+    backlog = args.backlog_factor * live
+    settle = args.settle_time
+    # name => (phases, live rate learned first, expected stop time range in s)
+    scenarios = {
+        "live, rate unknown": ([(live, settle + 4)], False, (settle, settle + 1.5)),
+        "live": ([(live, 6)], True, (0, 2.5)),
+        "backlog then live": ([(backlog, 4), (live, 8)], True, (4, 6.5)),
+        "long backlog then live": ([(backlog, 0.8 * settle), (live, 6)], True, (0.8 * settle, 0.8 * settle + 2.5)),
+    }
+
+    daq = DataProcess(port=args.port, persistent=True)
+    daq.start_connection()
+    failures = 0
+    print(f"{'scenario':<26}{'drained s':>10}{'expected s':>14}{'MB':>8}  reason")
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench_drain_") as folder:
+            for name, (phases, learn, (low, high)) in scenarios.items():
+                daq.live_rate = None
+                if learn:
+                    sender = threading.Thread(target=send, args=(daq.port, [(live, 3)], args.frame_events))
+                    sender.start()
+                    daq.run(duration=3, suffix="live", folder=folder)
+                    sender.join()
+                    discard_leftovers(daq)
+                stats = drain(daq, phases, args.frame_events, settle)
+                discard_leftovers(daq)
+                ok = low <= stats["seconds"] <= high
+                failures += not ok
+                print(f"{name:<26}{stats['seconds']:>10.1f}{f'{low:.1f}-{high:.1f}':>14}{stats['bytes'] / 1e6:>8.1f}  {stats['reason']}{'' if ok else '  <- FAILED'}")
+    finally:
+        daq.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
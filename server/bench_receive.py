@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Benchmark of the DAQ receive path: compares the legacy reception (recv_multipart with copies,
+struct.unpack_from and hex strings parsed by DataProcess.process_data) with the zero-copy
+reception (recv_multipart(copy=False) and the vectorized decoder on the frame buffers).
+
+The frames are sent over an inproc DEALER -> ROUTER pair, so no board is needed.
+Usage: python bench_receive.py --frames 200 --events 1024
+"""
+import argparse
+import struct
+import time
+import tracemalloc
+
+import numpy as np
+import zmq
+
+from data_processing import DataProcess
+from decoder import EVENT_WORDS, decode_frame
+
+
+class NullWriter:
+    def writerow(self, row):
+        pass
+
+
+def legacy_process(processor, part, writer):
+    """The reception loop of DataProcess.run before the vectorized decoder"""
+    l = int(len(part) / 2)
+    v = struct.unpack_from(f"{l}H", part)
+    a = ""
+    i = 0
+    for b in v:
+        a += f'{b:04x} '
+        i += 1
+        if i % 8 == 0:
+            processor.process_data(a.strip(), writer)
+            a = ""
+            i = 0
+    return l // EVENT_WORDS
+
+
+def zero_copy_process(processor, part, writer):
+    return len(decode_frame(part.buffer))
+
+
+def copy_vectorized_process(processor, part, writer):
+    return len(decode_frame(part))
+
+
+# Receive paths to compare => "name" : (copy, frame processing function)
+receive_paths = {
+    "legacy": (True, legacy_process),
+    "copy+vectorized": (True, copy_vectorized_process),
+    "zero-copy": (False, zero_copy_process),
+}
+
+
+def bench_path(context, name, frames, trace):
+    copy, process = receive_paths[name]
+    router = context.socket(zmq.ROUTER)
+    dealer = context.socket(zmq.DEALER)
+    router.setsockopt(zmq.RCVHWM, 0)
+    dealer.setsockopt(zmq.SNDHWM, 0)
+    router.bind(f"inproc://bench_{name}_{trace}")
+    dealer.connect(f"inproc://bench_{name}_{trace}")
+    for frame in frames:
+        dealer.send(frame, copy=False)
+
+    processor = DataProcess.__new__(DataProcess)
+    writer = NullWriter()
+    events = 0
+    peaks = 0
+    if trace:
+        tracemalloc.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in frames:
+        if trace:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        message = router.recv_multipart(copy=copy)
+        for part in message[1:]:
+            events += process(processor, part, writer)
+        del message
+        if trace:
+            peaks += tracemalloc.get_traced_memory()[1] - base
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    if trace:
+        tracemalloc.stop()
+    router.close()
+    dealer.close()
+    return events, cpu, wall, peaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the DAQ receive path")
+    parser.add_argument("--frames", type=int, default=200, help="Number of frames to receive")
+    parser.add_argument("--events", type=int, default=1024, help="Number of 8-word events per frame")
+    parser.add_argument("--legacy-frames", type=int, default=20, help="Number of frames for the (slow) legacy path")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    words = rng.integers(0, 1 << 16, size=(args.frames, args.events * EVENT_WORDS), dtype=np.uint16)
+    frames = [row.tobytes() for row in words]
+
+    context = zmq.Context()
+    print(f"{'path':<18}{'events':>10}{'ns/event (CPU)':>16}{'events/s':>14}{'alloc B/event':>15}")
+    for name in receive_paths:
+        selected = frames[:args.legacy_frames] if name == "legacy" else frames
+        events, cpu, wall, _ = bench_path(context, name, selected, trace=False)
+        _, _, _, peaks = bench_path(context, name, selected, trace=True)
+        print(f"{name:<18}{events:>10}{1e9 * cpu / events:>16.1f}{events / wall:>14.0f}{peaks / events:>15.1f}")
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
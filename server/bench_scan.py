@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Timing of the instrument scans on the simulated wheels and polarizer (see
+simulated_instruments.py): no optical bench and no pylablib are needed.
+
+The wheel grid of the wheels characterisation and the angles of the polarizer calibration are
+visited through InstrumentsManager.configure, in the given order and in the order of plan_scan.
+For every scan the measured motion time is compared with the estimate of the motion models, which
+are the ones of the simulation unless --models is given. With the failure probabilities the moves
+that fail are retried, up to MAX_RETRIES times in a row, and counted. The exit status is 1 if a
+move still fails after that.
+
+The times are in simulated seconds: --time-scale 0.01 runs the scans 100 times faster. With much
+smaller factors the overhead of the threads and of the sleeps inflates the measured times.
+Usage: python bench_scan.py --time-scale 0.01 --move-failure 0.02
+"""
+import argparse
+import sys
+import time
+from functools import partial
+
+from InstrumentManager import InstrumentsManager, instrument_ports
+from scan_planner import MotionModel, load_motion_models, plan_scan, total_time
+from simulated_instruments import SimulatedPolarizer, SimulatedWheels, opened, states
+
+
+# Positions of the simulated instruments when they are opened the first time
+INITIAL_POSITIONS = {"near_wheel": 1, "far_wheel": 1, "polarizer": 0.0}
+# Failed attempts in a row after which a configuration is given up
+MAX_RETRIES = 20
+
+
+def scans(near_start=1, far_start=1, pol_start=0, pol_ampl=110, pol_step=10):
+    """The configurations of the wheels characterisation and of the polarizer calibration"""
+    return {
+        "wheels": [{"near_wheel": i, "far_wheel": j} for i in range(near_start, 13) for j in range(far_start, 13)],
+        "polarizer": [{"polarizer": float(i)} for i in range(pol_start, pol_start + pol_ampl, pol_step)],
+    }
+
+
+def run_scan(manager, order, time_scale):
+    """
+    Visits the configurations in order. Returns the motion time in simulated seconds, the failed
+    moves and whether every configuration was reached.
+    """
+    failures = 0
+    start = time.perf_counter()
+    for config in order:
+        retries = 0
+        while manager.configure(**config) is None:
+            failures += 1
+            retries += 1
+            if retries > MAX_RETRIES:
+                print(f"Gave up reaching {config} after {MAX_RETRIES} retries")
+                return (time.perf_counter() - start) / time_scale, failures, False
+    return (time.perf_counter() - start) / time_scale, failures, True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Timing of the instrument scans on simulated instruments")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="Factor applied to every simulated wait")
+    parser.add_argument("--overhead", type=float, default=0.5, help="Fixed time of every move in seconds")
+    parser.add_argument("--per-position", type=float, default=0.5, help="Seconds per position of the wheels")
+    parser.add_argument("--velocity", type=float, default=10.0, help="Velocity of the polarizer in deg/s")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Relative standard deviation of the move times")
+    parser.add_argument("--check-failure", type=float, default=0.0, help="Probability that a position query fails")
+    parser.add_argument("--move-failure", type=float, default=0.0, help="Probability that a move fails")
+    parser.add_argument("--models", action="store_true", help="Plan with the measured motion models instead of the simulated ones")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the jitter and of the failures")
+    args = parser.parse_args()
+
+    options = dict(overhead=args.overhead, jitter=args.jitter, time_scale=args.time_scale,
+                   check_failure=args.check_failure, move_failure=args.move_failure, seed=args.seed)
+    ports = {
+        "near_wheel": (partial(SimulatedWheels, per_position=args.per_position, **options), instrument_ports["near_wheel"][1]),
+        "far_wheel": (partial(SimulatedWheels, per_position=args.per_position, **options), instrument_ports["far_wheel"][1]),
+        "polarizer": (partial(SimulatedPolarizer, velocity=args.velocity, **options), instrument_ports["polarizer"][1]),
+    }
+    if args.models:
+        models = load_motion_models()
+    else:
+        models = {"near_wheel": MotionModel(args.overhead, args.per_position, n_positions=12),
+                  "far_wheel": MotionModel(args.overhead, args.per_position, n_positions=12),
+                  "polarizer": MotionModel(args.overhead, 1 / args.velocity)}
+
+    complete = True
+    print(f"{'scan':<12}{'order':<9}{'configs':>8}{'estimate s':>12}{'measured s':>12}{'failures':>10}")
+    for name, configs in scans().items():
+        for label in ("given", "planned"):
+            # Every scan starts from the same positions
+            states.clear()
+            opened.clear()
+            manager = InstrumentsManager(lambda text: None, ports=ports)
+            start = {instrument: INITIAL_POSITIONS[instrument] for instrument in configs[0]}
+            order = configs if label == "given" else plan_scan(configs, start=start, models=models)[0]
+            estimate = total_time(order, models, start)
+            measured, failures, reached = run_scan(manager, order, args.time_scale)
+            manager.close()
+            complete &= reached
+            print(f"{name:<12}{label:<9}{len(order):>8}{estimate:>12.1f}{measured:>12.1f}{failures:>10}{'' if reached else '  <- FAILED'}")
+    sys.exit(0 if complete else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import logging
+import re
+import threading
+
+from data_processing import DataProcess
+
+
+logger = logging.getLogger("DataProcessing")
+
+# Port of the receiver of the first multiPMT, the following ones use the next ports
+DAQ_BASE_PORT = 5555
+
+
+def board_name(client_id):
+    """Name of a multiPMT used in the file names, from the identity of its client"""
+    name = client_id.decode(errors="replace") if isinstance(client_id, bytes) else str(client_id)
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+
+class BoardReceivers:
+    """
+    Receivers of the events of several multiPMTs, recorded in parallel.
+
+    Every board has its own DataProcess on its own port, so its own socket, ring buffer, consumer
+    process and decoders: a board sending at a high rate, or a slow output file, does not slow down
+    the others. The phases of an acquisition run for all the boards at the same time, so the
+    acquisition of a batch takes as long as the one of a single board. With a single board the
+    files keep the names they had before.
+
+    Parameters:
+        ports (dict): Port of the receiver of every board, by board identity.
+        decode_workers (int): Decoder processes shared out among the boards.
+    """
+
+    def __init__(self, ports, persistent=True, decode_workers=1):
+        workers = max(1, decode_workers // max(1, len(ports)))
+        self.receivers = {board_name(board): DataProcess(port, persistent, workers) for board, port in ports.items()}
+        self.run_stats = {}
+        self.fifo_stats = {}
+
+    def __len__(self):
+        return len(self.receivers)
+
+    def parallel(self, method, board_options=None, **kwargs):
+        """
+        Calls the same method of every receiver, each in its own thread, and returns the results by
+        board. board_options(name) can add arguments specific to each board. The first exception
+        raised is raised again once all the receivers are done.
+        """
+        results = {}
+        errors = {}
+
+        def call(name, receiver):
+            try:
+                options = dict(kwargs, **board_options(name)) if board_options else kwargs
+                results[name] = getattr(receiver, method)(**options)
+            except Exception as e:
+                logger.error(f"Board {name}: {method} failed: {e}")
+                errors[name] = e
+
+        threads = [threading.Thread(target=call, args=(name, receiver), name=f"{method}-{name}") for name, receiver in self.receivers.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise next(iter(errors.values()))
+        return {name: results[name] for name in self.receivers}
+
+    def signal_integrity(self, **kwargs):
+        """Checks the signal of all the boards. Passes only if every board passes"""
+        results = self.parallel("signal_integrity", **kwargs)
+        for name, passed in results.items():
+            if not passed:
+                logger.warning(f"Board {name}: signal integrity check failed")
+        return all(results.values())
+
+    def flush_fifo(self, **kwargs):
+        self.fifo_stats = self.parallel("flush_fifo", **kwargs)
+        return self.fifo_stats
+
+    def run(self, flag_acq="", run_id=None, number=None, **kwargs):
+        """
+        Records all the boards for the same duration, in the same run folder. Every board writes its
+        own files, named after the board. Returns the path of the acquisition file of every board.
+        """
+        # The folder is chosen once: concurrent receivers would pick different acq_<i> folders
+        folder = DataProcess.get_run_folder(flag_acq, run_id, number)
+        single = len(self.receivers) == 1
+        paths = self.parallel("run", lambda name: {"board": None if single else name},
+                              flag_acq=flag_acq, run_id=run_id, number=number, folder=folder, **kwargs)
+        self.run_stats = {name: receiver.run_stats for name, receiver in self.receivers.items()}
+        return paths
+
+    def recording(self):
+        """True while the receivers are recording, after the integrity check and the FIFO drain"""
+        return any(receiver.phase == "record" for receiver in self.receivers.values())
+
+    def rates(self, window=10.0):
+        """Rates of the acquisition being recorded, by board"""
+        return {name: receiver.rates(window) for name, receiver in self.receivers.items()}
+
+    def close(self):
+        for receiver in self.receivers.values():
+            receiver.close()
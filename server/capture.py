@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#coding=utf-8
+import argparse
+import logging
+import struct
+import time
+from pathlib import Path
+
+from decoder import EventFramer, TimestampUnwrapper, decode_words, frame_to_words
+from histograms import ChannelHistograms
+from validation import EventValidator, RejectWriter
+from writers import FlushPolicy, get_writer_class
+
+
+logger = logging.getLogger("DataProcessing")
+
+# Name of the output format used to store the raw frames of an acquisition
+CAPTURE_OUTPUT = "raw"
+
+CAPTURE_MAGIC = b"MPMTCAP1"
+# Every frame is preceded by its length in bytes and by the host receive time in nanoseconds
+RECORD_HEADER = struct.Struct("<IQ")
+
+
+class CaptureWriter:
+    """
+    Appends the raw frames received from the evproducer to a capture file, without decoding them.
+    The capture file can be decoded later with decode_capture().
+
+    The frames are accumulated in the buffer of the file object and written with the same
+    FlushPolicy used for the decoded events.
+    """
+
+    extension = "cap"
+
+    def __init__(self, path, policy=None, buffer_size=8 * 1024 * 1024):
+        self.path = Path(path)
+        self.policy = policy or FlushPolicy()
+        self.file = open(self.path, "ab", buffering=buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.frames = 0
+        self.bytes = 0
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def feed(self, frame, timestamp_ns=None):
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        nbytes = memoryview(frame).nbytes
+        self.file.write(RECORD_HEADER.pack(nbytes, timestamp_ns))
+        self.file.write(frame)
+        self.frames += 1
+        self.bytes += nbytes
+        # The flush policy counts frames instead of events
+        self.pending += 1
+        self.tick()
+
+    def tick(self):
+        if self.policy.should_flush(self.pending, self.last_flush):
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+            logger.info(f"Captured {self.frames} frames ({self.bytes} bytes) in {self.path}")
+        return {"frames": self.frames, "bytes": self.bytes}
+
+
+def iter_capture(path, buffer_size=8 * 1024 * 1024):
+    """
+    Yields (host receive time in ns, frame) for every frame of a capture file.
+    A truncated last record, as left by a crash, is ignored.
+    """
+    with open(path, "rb", buffering=buffer_size) as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            nbytes, timestamp_ns = RECORD_HEADER.unpack(header)
+            frame = file.read(nbytes)
+            if len(frame) < nbytes:
+                logger.warning(f"Truncated frame at the end of {path}")
+                break
+            yield timestamp_ns, frame
+
+
+def decode_capture(path, out_path=None, output="npy"):
+    """
+    Decodes a capture file in the normal output format, next to the capture file by default,
+    together with the same histograms and reject file produced during a decoded acquisition.
+    Returns the path of the decoded file.
+    """
+    path = Path(path)
+    writer_class = get_writer_class(output)
+    out_path = Path(out_path) if out_path else path.with_suffix(f".{writer_class.extension}")
+    frames = 0
+    histograms = ChannelHistograms()
+    framer = EventFramer()
+    validator = EventValidator(RejectWriter.path_for(out_path))
+    timestamps = None
+    with writer_class(out_path, FlushPolicy(max_events=1_000_000, interval=None)) as writer:
+        for timestamp_ns, frame in iter_capture(path):
+            if timestamps is None:
+                # Anchored to the receive time of the first frame, as during a decoded acquisition
+                timestamps = TimestampUnwrapper(timestamp_ns / 1e9)
+            words = framer.push(frame_to_words(frame))
+            events = timestamps.apply(decode_words(validator.validate(words, framer.take_rejects())))
+            writer.write(events)
+            histograms.update(events)
+            frames += 1
+    framer.finish()
+    validator.close(framer.events_discarded)
+    if timestamps:
+        timestamps.stats()
+    histograms.save(ChannelHistograms.path_for(out_path))
+    logger.info(f"Decoded {writer.events_written} events from {frames} frames of {path} into {out_path}")
+    if framer.events_recovered or framer.events_discarded:
+        logger.info(f"Framing: {framer.events_recovered} events recovered across frames, {framer.events_discarded} broken events discarded")
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode raw capture files of the multiPMT DAQ")
+    parser.add_argument("files", nargs="+", help="The capture files to decode")
+    parser.add_argument("--output", type=str, default="npy", help="The output format (npy or csv)")
+    args = parser.parse_args()
+    for fname in args.files:
+        print(decode_capture(fname, output=args.output))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Streaming search of coincidences between the channels of a multiPMT.
+
+The decoded blocks are merged in time order with the events left over from the previous blocks
+and cut into clusters: consecutive events closer than the coincidence window belong to the same
+cluster. The multiplicity of a cluster is the number of different channels it contains. The
+cost is linear in the number of events, apart from the sort of every block, which is nearly
+linear since the events of each channel already arrive in time order.
+
+Usage on acquisitions already saved: python coincidence.py file.npy [...] [--window 100] [--groups]
+"""
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from decoder import EVENT_DTYPE, TIMESTAMP_HZ
+from histograms import N_CHANNELS
+from writers import FlushPolicy, NpyEventWriter, read_events
+
+
+logger = logging.getLogger("DataProcessing")
+
+# Default coincidence window in nanoseconds
+COINCIDENCE_WINDOW = 100
+
+# Events of the matched groups, with the number of the group they belong to
+GROUP_EVENT_DTYPE = np.dtype(EVENT_DTYPE.descr + [("group", np.uint64)])
+
+
+class GroupWriter(NpyEventWriter):
+    """Stores the events of the coincidences found in an acquisition in a .npy file next to the data file"""
+
+    dtype = GROUP_EVENT_DTYPE
+
+    @staticmethod
+    def path_for(data_path):
+        data_path = Path(data_path)
+        return data_path.with_name(f"{data_path.stem}_coinc.{NpyEventWriter.extension}")
+
+
+class CoincidenceFinder:
+    """
+    Counts the coincidences between channels in the stream of decoded events, which must carry
+    their absolute timestamp.
+
+    Parameters:
+        window (float): Coincidence window in nanoseconds.
+        min_multiplicity (int): Clusters with at least this many channels are counted as coincidences.
+        group_path (str): If given, the events of every coincidence are saved in this file with a group number.
+        max_lag (float): Seconds an event can wait for the events of the other channels before its
+            cluster is closed, so that a silent channel does not hold back the search.
+
+    Blocks can interleave the channels in any way: a cluster is closed only when every channel
+    present in the last block has moved past it, or when it is older than max_lag.
+    """
+
+    def __init__(self, window=COINCIDENCE_WINDOW, min_multiplicity=2, n_channels=N_CHANNELS, group_path=None, policy=None, max_lag=1.0):
+        self.window = window
+        self.window_ticks = int(round(window * 1e-9 * TIMESTAMP_HZ))
+        self.max_lag_ticks = int(max_lag * TIMESTAMP_HZ)
+        self.min_multiplicity = min_multiplicity
+        self.n_channels = n_channels
+        self.popcount = np.array([bin(mask).count("1") for mask in range(1 << n_channels)], dtype=np.uint8)
+        self.writer = GroupWriter(group_path, policy) if group_path else None
+        # Timestamps and channels of the events of the clusters still open, and the events themselves if they are saved
+        self.tail_timestamp = np.empty(0, dtype=np.uint64)
+        self.tail_channel = np.empty(0, dtype=np.uint8)
+        self.tail_events = np.empty(0, dtype=EVENT_DTYPE)
+        self.last_seen = np.zeros(n_channels, dtype=np.uint64)
+        self.multiplicity = np.zeros(n_channels + 1, dtype=np.int64)
+        self.coincidences = 0
+
+    def update(self, events):
+        # The columns are copied out of the packed records: operations on them are much faster
+        channel = np.ascontiguousarray(events["channel"])
+        valid = channel < self.n_channels
+        if not valid.all():
+            events = events[valid]
+            channel = channel[valid]
+        if not len(events):
+            return
+        timestamp = np.ascontiguousarray(events["timestamp"])
+        np.maximum.at(self.last_seen, channel.astype(np.intp), timestamp)
+        present = np.bincount(channel, minlength=self.n_channels) > 0
+
+        timestamp = np.concatenate((self.tail_timestamp, timestamp))
+        channel = np.concatenate((self.tail_channel, channel))
+        if self.writer:
+            events = np.concatenate((self.tail_events, events))
+        if (timestamp[1:] < timestamp[:-1]).any():
+            # Each channel is already in time order: the stable sort (timsort) only merges the runs
+            order = np.argsort(timestamp, kind="stable")
+            timestamp = timestamp[order]
+            channel = channel[order]
+            if self.writer:
+                events = events[order]
+
+        watermark = max(int(self.last_seen[present].min()), int(timestamp[-1]) - self.max_lag_ticks)
+        self.process(timestamp, channel, events, watermark)
+
+    def process(self, timestamp, channel, events, watermark=None):
+        """Closes the clusters that end before watermark - window (all of them without watermark)"""
+        ends = np.flatnonzero(np.diff(timestamp) > self.window_ticks)
+        if watermark is None:
+            cut = len(timestamp)
+        else:
+            closed = ends[timestamp[ends] + self.window_ticks < watermark]
+            cut = int(closed[-1]) + 1 if len(closed) else 0
+            ends = closed
+        self.tail_timestamp = timestamp[cut:]
+        self.tail_channel = channel[cut:]
+        if self.writer:
+            self.tail_events = events[cut:]
+        if not cut:
+            return
+
+        starts = np.concatenate(([0], ends[ends < cut - 1] + 1))
+        masks = np.bitwise_or.reduceat(np.left_shift(1, channel[:cut].astype(np.intp)), starts)
+        multiplicity = self.popcount[masks]
+        self.multiplicity += np.bincount(multiplicity, minlength=self.n_channels + 1)
+        matched = multiplicity >= self.min_multiplicity
+        n_matched = int(np.count_nonzero(matched))
+        self.coincidences += n_matched
+
+        if self.writer and n_matched:
+            sizes = np.diff(np.append(starts, cut))
+            cluster = np.repeat(np.arange(len(starts)), sizes)
+            keep = np.flatnonzero(matched[cluster])
+            groups = np.empty(len(keep), dtype=GROUP_EVENT_DTYPE)
+            for name in EVENT_DTYPE.names:
+                groups[name] = events[name][keep]
+            # Groups are numbered from the first coincidence of the run
+            groups["group"] = self.coincidences - n_matched + np.cumsum(matched)[cluster[keep]] - 1
+            self.writer.write(groups)
+
+    def tick(self):
+        if self.writer:
+            self.writer.tick()
+
+    def close(self):
+        """Closes the clusters still open and returns the statistics of the run"""
+        if len(self.tail_timestamp):
+            self.process(self.tail_timestamp, self.tail_channel, self.tail_events)
+        if self.writer:
+            self.writer.close()
+        stats = {"window": self.window, "multiplicity": self.multiplicity.tolist(), "coincidences": self.coincidences}
+        logger.info(f"Coincidences within {self.window} ns: {self.coincidences}. Clusters per multiplicity: {stats['multiplicity']}")
+        return stats
+
+    def save(self, path):
+        """Saves the multiplicity counts in a .npz file"""
+        np.savez(path, multiplicity=self.multiplicity, window=self.window, min_multiplicity=self.min_multiplicity)
+        return path
+
+    @staticmethod
+    def path_for(data_path):
+        """Path of the multiplicity counts saved next to an acquisition file"""
+        data_path = Path(data_path)
+        return data_path.with_name(f"{data_path.stem}_coinc.npz")
+
+
+def find_coincidences(path, window=COINCIDENCE_WINDOW, min_multiplicity=2, groups=False, chunk_size=1_000_000):
+    """Searches the coincidences of a .npy acquisition file, in chunks. Returns the statistics"""
+    path = Path(path)
+    events = read_events(path)
+    finder = CoincidenceFinder(window, min_multiplicity, group_path=GroupWriter.path_for(path) if groups else None,
+                               policy=FlushPolicy(max_events=chunk_size, interval=None))
+    for start in range(0, len(events), chunk_size):
+        finder.update(np.asarray(events[start:start + chunk_size]))
+    stats = finder.close()
+    finder.save(CoincidenceFinder.path_for(path))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the coincidences between channels in .npy acquisition files")
+    parser.add_argument("files", nargs="+", help="The .npy acquisition files")
+    parser.add_argument("--window", type=float, default=COINCIDENCE_WINDOW, help="The coincidence window in ns")
+    parser.add_argument("--min-multiplicity", type=int, default=2, help="The minimum number of channels of a coincidence")
+    parser.add_argument("--groups", action="store_true", help="Save also the events of every coincidence")
+    args = parser.parse_args()
+    for fname in args.files:
+        stats = find_coincidences(fname, args.window, args.min_multiplicity, args.groups)
+        print(f"{fname}: {stats['coincidences']} coincidences, clusters per multiplicity {stats['multiplicity']}")
@@ -2,10 +2,21 @@ import zmq
 import logging
 import datetime
 import os
-import struct
-import csv
 import time
 from pathlib import Path
+import multiprocessing as mp
+import queue
+from array import array
+import numpy as np
+from capture import CAPTURE_OUTPUT, CaptureWriter
+from coincidence import CoincidenceFinder, GroupWriter
+from decode_pool import ShardedDecoder
+from decoder import EVENT_WORDS, TIMESTAMP_HZ, EventFramer, TimestampUnwrapper, decode_words, frame_to_words
+from histograms import ChannelHistograms, ChannelStats
+from ratemeter import RateMeter
+from ring_buffer import DEFAULT_RING_SIZE, FrameRing
+from validation import CHECK_CRC, EventValidator, RejectWriter
+from writers import FlushPolicy, flush_policies, get_writer_class
 
 #########################################
 logger = logging.getLogger("DataProcessing")
@@ -37,13 +48,208 @@ folder_acq = {
     "fiber_char" : "fiber_characterisation/"
 }
 
+class FrameConsumer:
+    """
+    Decodes the frames received from the evproducer, passes the events to the output writer and
+    fills the per-channel histograms saved next to the data file at the end of the run.
+    The frames go through an EventFramer first, so events split across frames are not lost, and
+    the events failing the framing or channel checks, and with check_crc the CRC check, are written
+    to the reject file instead. The absolute timestamps are anchored to the host clock when the consumer is created.
+
+    With coincidence_window (ns) set, the coincidences between channels are searched during the
+    run; with coincidence_groups the events of every coincidence are also saved.
+    With rate_buffer (see RateMeter.shared_buffer()) the rates of the run are kept up to date in it.
+
+    With decode_workers > 1 the frames are grouped in blocks of about block_bytes bytes and decoded
+    by a ShardedDecoder pool; the decoded blocks come back in arrival order.
+
+    The CPU time spent in every stage is accounted in stage_time, and the latency of every block,
+    the host time when it is decoded minus the timestamp of its last event, is recorded. The latency
+    is meaningful only when the clock of the board follows the host clock, as with the synthetic
+    evproducer.
+    """
+
+    stages = ("framing", "decode", "timestamps", "write", "histograms", "rates", "coincidences")
+
+    def __init__(self, filepath, output="npy", flush_policy=None, decode_workers=1, block_bytes=1 << 20, coincidence_window=None, coincidence_groups=False, rate_buffer=None, check_crc=CHECK_CRC):
+        self.writer = get_writer_class(output)(filepath, flush_policy)
+        self.histograms = ChannelHistograms()
+        self.pool = ShardedDecoder(decode_workers) if decode_workers > 1 else None
+        self.framer = EventFramer()
+        self.timestamps = TimestampUnwrapper()
+        self.validator = EventValidator(RejectWriter.path_for(self.writer.path), policy=flush_policy, check_crc=check_crc)
+        self.rates = RateMeter(rate_buffer) if rate_buffer is not None else None
+        self.coincidences = None
+        if coincidence_window:
+            group_path = GroupWriter.path_for(self.writer.path) if coincidence_groups else None
+            self.coincidences = CoincidenceFinder(coincidence_window, group_path=group_path, policy=flush_policy)
+        self.block = []
+        self.block_size = 0
+        self.block_bytes = block_bytes
+        self.frames = 0
+        self.events = 0
+        self.cpu_time = 0.0
+        self.stage_time = dict.fromkeys(FrameConsumer.stages, 0.0)
+        self.latency = array("d")
+
+    def lap(self, stage, since):
+        """Adds the CPU time since since to a stage. Returns the current CPU time"""
+        now = time.process_time()
+        self.stage_time[stage] += now - since
+        return now
+
+    def feed(self, frame):
+        start = time.process_time()
+        if self.rates:
+            self.rates.add_bytes(memoryview(frame).nbytes)
+        words = self.framer.push(frame_to_words(frame))
+        if self.framer.rejects:
+            self.validator.validate(words[:0], self.framer.take_rejects())
+        clock = self.lap("framing", start)
+        if self.pool:
+            # The events are copied out of the receive buffer before being handed to the workers
+            if len(words):
+                self.block.append(words.tobytes())
+                self.block_size += len(self.block[-1])
+            if self.block_size >= self.block_bytes:
+                self.submit_block()
+            self.lap("decode", clock)
+            for events, rejects in self.pool.ready():
+                self.process_events(events, rejects)
+        else:
+            events = decode_words(self.validator.validate(words))
+            self.lap("decode", clock)
+            self.process_events(events)
+        self.frames += 1
+        self.cpu_time += time.process_time() - start
+
+    def submit_block(self):
+        if self.block:
+            # The first events decide if the CRC definition matches the front-end
+            if self.validator.check_crc is None:
+                self.validator.decide_crc(np.frombuffer(self.block[0], dtype=np.uint16).reshape(-1, EVENT_WORDS))
+            self.pool.submit(self.block, bool(self.validator.check_crc))
+            self.block = []
+            self.block_size = 0
+
+    def process_events(self, events, rejects=None):
+        clock = time.process_time()
+        if rejects is not None:
+            self.validator.record(rejects)
+        self.timestamps.apply(events)
+        if len(events):
+            self.latency.append(time.time() - int(events["timestamp"][-1]) / TIMESTAMP_HZ)
+        clock = self.lap("timestamps", clock)
+        self.writer.write(events)
+        clock = self.lap("write", clock)
+        self.histograms.update(events)
+        clock = self.lap("histograms", clock)
+        if self.rates:
+            self.rates.update(events)
+            clock = self.lap("rates", clock)
+        if self.coincidences:
+            self.coincidences.update(events)
+            self.lap("coincidences", clock)
+        self.events += len(events)
+
+    def latency_stats(self):
+        """Percentiles of the latency of the blocks, in seconds"""
+        if not len(self.latency):
+            return {}
+        latency = np.frombuffer(self.latency, dtype=np.float64)
+        p50, p99 = np.percentile(latency, [50, 99])
+        return {"blocks": len(latency), "min": float(latency.min()), "p50": float(p50), "p99": float(p99), "max": float(latency.max())}
+
+    def tick(self):
+        if self.pool:
+            # Nothing else is arriving: the partial block does not have to wait to be decoded
+            self.submit_block()
+            for events, rejects in self.pool.ready():
+                self.process_events(events, rejects)
+        self.writer.tick()
+        self.validator.tick()
+        if self.coincidences:
+            self.coincidences.tick()
+
+    def close(self):
+        self.framer.finish()
+        if self.pool:
+            self.submit_block()
+            for events, rejects in self.pool.close():
+                self.process_events(events, rejects)
+        self.writer.close()
+        self.histograms.save(ChannelHistograms.path_for(self.writer.path))
+        stats = {"frames": self.frames, "events": self.events, "cpu_time": self.cpu_time,
+                 "events_per_channel": self.histograms.counts().tolist(), "framing": self.framer.stats(),
+                 "timestamp_anchor": self.timestamps.anchor, "timestamps": self.timestamps.stats(), "stage_time": self.stage_time, "latency": self.latency_stats(),
+                 "rejected": self.validator.close(self.framer.events_discarded)}
+        if self.coincidences:
+            stats["coincidences"] = self.coincidences.close()
+            self.coincidences.save(CoincidenceFinder.path_for(self.writer.path))
+        logger.info(f"Decoded {self.events} events from {self.frames} frames in {self.cpu_time:.2f} s of CPU time")
+        if self.framer.events_recovered or self.framer.events_discarded:
+            logger.info(f"Framing: {self.framer.events_recovered} events recovered across frames, "
+                        f"{self.framer.events_discarded} broken events discarded ({self.framer.words_discarded} words)")
+        return stats
+
+
+def consume_ring(ring_name, ring_size, filepath, output, flush_policy, decode_workers, options, stop, results):
+    """
+    Entry point of the consumer process: decodes and writes the frames found in the ring until
+    the receiver sets the stop event and the ring is empty, then reports its statistics.
+    """
+    ring = FrameRing(ring_size, name=ring_name)
+    consumer = FrameConsumer(filepath, output, flush_policy, decode_workers, **options)
+    receiver = mp.parent_process()
+    try:
+        while True:
+            frame = ring.read()
+            if frame is None:
+                if stop.is_set() and ring.used() == 0:
+                    break
+                if receiver is not None and not receiver.is_alive():
+                    logger.error("The receiver process died. Closing the acquisition")
+                    break
+                consumer.tick()
+                time.sleep(0.001)
+                continue
+            try:
+                consumer.feed(frame)
+            except Exception as e:
+                logger.error(f"Some problems occured decoding the received frame: {e}")
+    finally:
+        ring.release()
+        stats = consumer.close()
+        ring.close()
+        results.put(stats)
+
+
 class DataProcess:
+    """
+    Receiver of the frames sent by the evproducer.
+
+    With persistent=True the ROUTER socket is bound once and kept open across the integrity check,
+    FIFO drain and recording phases of all the acquisitions, until close() is called. Otherwise
+    the socket and the context are released at the end of every phase.
+    decode_workers sets the number of decoder processes used while recording.
+    While recording, the per-channel rates can be read from another thread with rates().
+    """
 
-    def __init__(self, port=5555):
+    def __init__(self, port=5555, persistent=False, decode_workers=1):
         self.port = port
+        self.persistent = persistent
+        self.decode_workers = decode_workers
         self.context = zmq.Context()
         self.server = None
+        self.phase = "idle"
         self.opened_files = []
+        self.run_stats = {}
+        self.fifo_stats = {}
+        # Byte rate of the last acquisition, the live rate expected when the FIFO is drained
+        self.live_rate = None
+        # Filled by the consumer, also when it runs in its own process
+        self.rate_buffer = RateMeter.shared_buffer()
+        self.rate_meter = RateMeter(self.rate_buffer)
         logger.debug("DataProcess initialized with port %s", self.port)
 
     @staticmethod
@@ -55,10 +261,10 @@ class DataProcess:
         return datetime.datetime.now().strftime('%Y_%m_%d')
     
     @staticmethod
-    def get_file_name(suffix):
+    def get_file_name(suffix, extension="csv"):
         timestamp = DataProcess.generate_timestamp()
         file_prefix = "daq"
-        return f"{file_prefix}_{timestamp}_{suffix}.csv"
+        return f"{file_prefix}_{timestamp}_{suffix}.{extension}"
     
     @staticmethod
     def check_file_exists(fname):
@@ -70,6 +276,11 @@ class DataProcess:
         return fname
 
     def start_connection(self):
+        if self.server is not None:
+            logger.debug(f"Reusing the socket bound on port {self.port}")
+            return
+        if self.context.closed:
+            self.context = zmq.Context()
         try:
             self.server = self.context.socket(zmq.ROUTER)
             self.server.setsockopt(zmq.HEARTBEAT_IVL, HEARTBEAT_IVL)
@@ -85,18 +296,33 @@ class DataProcess:
     def clean_up(self):
         logger.debug("Cleaning up opened files and sockets")
         self.opened_files.clear()
+        self.phase = "idle"
+        if self.persistent:
+            logger.debug("Persistent session: socket kept open for the next phase")
+            return
+        self.close()
+
+    def clean_up_fifo(self):
+        logger.debug("Cleaning up opened  sockets")
+        self.phase = "idle"
+        if self.persistent:
+            logger.debug("Persistent session: socket kept open for the next phase")
+            return
         if self.server:
             self.server.close()
-            self.context.term()
-            logger.debug("Server and context cleared")
+            self.server = None
+            logger.debug("Server cleared")
 
         logger.info("Everything has been cleared")
 
-    def clean_up_fifo(self):
-        logger.debug("Cleaning up opened  sockets")
+    def close(self):
+        """Closes the socket and terminates the context, also for a persistent session"""
         if self.server:
             self.server.close()
-            logger.debug("Server cleared")
+            self.server = None
+        if not self.context.closed:
+            self.context.term()
+        logger.debug("Server and context cleared")
 
         logger.info("Everything has been cleared")
 
@@ -110,83 +336,155 @@ class DataProcess:
             folder = base_folder / f"acq_{i}"
         return folder
     
+    @staticmethod
+    def get_run_folder(acq_type, run_id, number):
+        """Folder of an acquisition under the batch folder: run_<run_id>, or the first free acq_<i>"""
+        base_folder = Path("/swgo") / "multiPMT" / "calibration" / f"batch_{number}" / folder_acq.get(acq_type, "unknown") / DataProcess.generate_timestamp_folder()
+        if run_id is not None:
+            return base_folder / f"run_{run_id}"
+        i = 1
+        run_folder = base_folder / f"acq_{i}"
+        while run_folder.exists():
+            i += 1
+            run_folder = base_folder / f"acq_{i}"
+        return run_folder
+
     def string_no_space(self, string):
         return string.replace(" ", "")
 
 
 
-    def run(self, duration=None, suffix="", flag_acq = "", run_id = None, number = None): 
+    def run(self, duration=None, suffix="", flag_acq = "", run_id = None, number = None, output = "npy", flush_policy = None, ring_size = DEFAULT_RING_SIZE, coincidence_window = None, coincidence_groups = False, folder = None, board = None, check_crc = CHECK_CRC): 
+        """
+        Records the events sent by the evproducer for duration seconds.
+
+        With ring_size set, this process only receives the frames and copies them in a shared-memory
+        ring, while a separate consumer process decodes and writes them, so that slow disk writes
+        cannot delay the reception. With ring_size=None everything happens in this process.
+        With output="raw" the frames are not decoded but appended to a capture file, together with
+        their receive time, to be decoded offline with capture.decode_capture().
+        With coincidence_window (ns) set, the coincidences between channels are counted during the
+        run, and with coincidence_groups their events are saved next to the acquisition file.
+        folder replaces the run folder chosen from flag_acq, run_id and number, and board is added
+        to the file name, so that the receivers of several multiPMTs can share the same run folder.
+        With check_crc the CRC of every event is checked too, see validation.CHECK_CRC.
+        Returns the path of the acquisition file.
+        """
         self.start_connection()
         if not self.server:
             logger.error("Server is not initialized. Exiting run method.")
             return
         
+        self.phase = "record"
         poller = zmq.Poller()
         poller.register(self.server, zmq.POLLIN)  # Controlla se ci sono dati disponibili
         
-        base_folder = Path("/swgo") / "multiPMT" / "calibration" / f"batch_{number}" / folder_acq.get(flag_acq, "unknown") / DataProcess.generate_timestamp_folder()
-        
-        if run_id is not None:
-            run_folder = base_folder / f"run_{run_id}"
-        else:
-            i = 1
-            run_folder = base_folder / f"acq_{i}"
-            while run_folder.exists():
-                i += 1
-                run_folder = base_folder / f"acq_{i}"
-
+        run_folder = Path(folder) if folder is not None else DataProcess.get_run_folder(flag_acq, run_id, number)
         run_folder.mkdir(parents=True, exist_ok=True)
 
-        filename = self.check_file_exists(DataProcess.get_file_name(suffix))
-        filepath = run_folder / filename
-        filepath = Path(filepath).expanduser()
+        if output == CAPTURE_OUTPUT:
+            # The raw frames are appended with their receive time directly by the receiver
+            writer_class = CaptureWriter
+            ring_size = None
+        else:
+            writer_class = get_writer_class(output)
+        filename = DataProcess.get_file_name(suffix if board is None else f"{suffix}_{board}", writer_class.extension)
+        filepath = Path(self.check_file_exists(str(run_folder / filename))).expanduser()
         
-        with open(filepath, 'a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["Channel", "Unix_time_16_bit", "Coarse_time", "TDC_time", "ToT_time", "TDC_trigger_end", "Energy", "CRC"])
-            
-            start_time = time.time()
-            logger.info("Starting the communication with the DMA")
+        if isinstance(flush_policy, str):
+            flush_policy = flush_policies[flush_policy]
+        flush_policy = flush_policy or FlushPolicy()
+        # The poller has to wake up at least once per flush interval to honour the time policy
+        poll_timeout = 5000 if flush_policy.interval is None else int(min(5000, flush_policy.interval * 1000))
+
+        self.rate_meter.reset()
+        options = {"coincidence_window": coincidence_window, "coincidence_groups": coincidence_groups, "rate_buffer": self.rate_buffer, "check_crc": check_crc}
+        if ring_size:
+            ring = FrameRing(ring_size)
+            stop = mp.Event()
+            results = mp.Queue()
+            # Not a daemon, so that it can start its own decoder processes. It stops by itself if the receiver dies
+            consumer = mp.Process(target=consume_ring, args=(ring.name, ring_size, filepath, output, flush_policy, self.decode_workers, options, stop, results))
+            consumer.start()
+            sink = ring.write
+            logger.info(f"Started consumer process {consumer.pid} on a ring of {ring.capacity} bytes")
+        elif output == CAPTURE_OUTPUT:
+            consumer = CaptureWriter(filepath, flush_policy)
+            sink = consumer.feed
+        else:
+            consumer = FrameConsumer(filepath, output, flush_policy, self.decode_workers, **options)
+            sink = consumer.feed
+
+        start_time = time.time()
+        received_bytes = 0
+        # CPU time of this thread only: the receivers of other boards may run in the same process
+        receive_start = time.thread_time()
+        logger.info(f"Starting the communication with the DMA. Flush policy: {flush_policy}")
+        try:
             while duration is None or time.time() - start_time < duration:
-                socks = dict(poller.poll(timeout=5000))  
+                socks = dict(poller.poll(timeout=poll_timeout))  
                 
                 if self.server in socks and socks[self.server] == zmq.POLLIN:
                     try:
-                        message = self.server.recv_multipart()
+                        message = self.server.recv_multipart(copy=False)
                     except zmq.ZMQError as e: 
                         logger.error("Failed to receive messages: %s", e)
                         continue
                     
-                    for part in message:
+                    # The first part is the identity of the evproducer added by the ROUTER socket.
+                    # The frames are not copied by zmq, their buffers go straight to the ring or to the decoder
+                    for part in message[1:]:
+                        received_bytes += len(part)
                         if len(part) != 1:
-                            l = int(len(part) / 2)
                             try:
-                                v = struct.unpack_from(f"{l}H", part)
-                            except Exception as ex:
-                                logger.error("Error in struct.unpack_from: %s", ex)
-                                continue 
-                            
-                            a = ""
-                            i = 0
-                            for b in v:
-                                value = f'{b:04x} ' 
-                                i += 1
-                                a += value
-                                if i % 8 == 0: 
-                                    try:
-                                        self.process_data(a.strip(), writer)
-                                        file.flush()
-                                        a = ""
-                                        i = 0
-                                    except Exception as e:
-                                        logger.error(f"Some problems occured when putting the data in the queue: {e}")
+                                sink(part.buffer)
+                            except Exception as e:
+                                logger.error(f"Some problems occured decoding the received frame: {e}")
                 else:
-                    logger.debug("No message received in 5 seconds. Continuing...")
+                    if not ring_size:
+                        consumer.tick()
+                    logger.debug(f"No message received in {poll_timeout / 1000} seconds. Continuing...")
+        finally:
+            if ring_size:
+                stop.set()
+                try:
+                    self.run_stats = results.get(timeout=60)
+                except queue.Empty:
+                    logger.error("The consumer process did not report its statistics")
+                    self.run_stats = {}
+                consumer.join(timeout=5)
+                self.run_stats["ring"] = ring.stats()
+                ring.close()
+                self.report_ring(self.run_stats["ring"])
+            else:
+                self.run_stats = consumer.close()
+            # Without the ring this includes the decoding done by the consumer
+            self.run_stats["receive_time"] = time.thread_time() - receive_start
+            elapsed = time.time() - start_time
+            if elapsed >= 1.0:
+                self.live_rate = received_bytes / elapsed
+
+        logger.info("Closing and flushing file. Starting clean up")        
+        self.clean_up()
+        logger.info("DataProcess.run terminated")
+        return filepath
+
+    def rates(self, window=10.0):
+        """
+        Returns the per-channel event and byte rates of the acquisition being recorded (or of the
+        last one) over the last window seconds, together with the current phase.
+        """
+        rates = self.rate_meter.rates(window)
+        rates["phase"] = self.phase
+        return rates
 
-            file.flush()
-            logger.info("Closing and flushing file. Starting clean up")        
-            self.clean_up()
-            logger.info("DataProcess.run terminated")
+    @staticmethod
+    def report_ring(stats):
+        occupancy = 100 * stats["mean_occupancy"] / stats["capacity"]
+        high_water = 100 * stats["high_water"] / stats["capacity"]
+        logger.info(f"Ring buffer: {stats['frames_written']} frames, mean occupancy {occupancy:.1f}%, maximum occupancy {high_water:.1f}%")
+        if stats["frames_dropped"]:
+            logger.warning(f"Ring buffer overruns: {stats['frames_dropped']} frames ({stats['bytes_dropped']} bytes) dropped")
 
     
     def process_data(self, event, writer):
@@ -233,132 +531,154 @@ class DataProcess:
 
 
     
-    def flush_fifo(self, duration=60): 
+    def flush_fifo(self, duration=60, idle=1.0, window=0.25, settle_windows=4, tolerance=0.2, settle_time=10.0, live_rate=None): 
+        """
+        Discards the stale events in the board FIFO until no frame arrives or the rate settles at the
+        live rate. Returns the amount drained and the time it took.
+        """
         self.start_connection()
         if not self.server:
             logger.error("Server is not initialized. Exiting run method.")
             return
          
-            
-        start_time = time.time()
+        self.phase = "drain"
+        poller = zmq.Poller()
+        poller.register(self.server, zmq.POLLIN)
+
+        frames = 0
+        drained_bytes = 0
+        rates = []
+        peak_rate = 0.0
+        streak = []
+        streak_start = None
+        live_rate = self.live_rate if live_rate is None else live_rate
+        reason = "timeout"
+        start_time = time.monotonic()
+        last_frame = window_start = start_time
+        window_bytes = 0
         logger.info("Starting the communication with the DMA to empty the FIFO")
-        while duration is None or time.time() - start_time < duration:
-            try:
-                message = self.server.recv_multipart()
-            except zmq.Again:
-                logger.debug("No message received in 5 seconds. Retrying...")
-                continue
-            except zmq.ZMQError as e: 
-                logger.error("Failed to receive messages: %s", e)
-                continue
-        
+        while duration is None or time.monotonic() - start_time < duration:
+            socks = dict(poller.poll(timeout=int(window * 1000)))
+            now = time.monotonic()
+            if self.server in socks:
+                try:
+                    message = self.server.recv_multipart(copy=False)
+                except zmq.ZMQError as e: 
+                    logger.error("Failed to receive messages: %s", e)
+                    continue
+                size = sum(len(part) for part in message[1:])
+                frames += 1
+                drained_bytes += size
+                window_bytes += size
+                last_frame = now
+            elif now - last_frame >= idle:
+                reason = "idle"
+                break
+
+            if now - window_start >= window:
+                rate = window_bytes / (now - window_start)
+                rates.append(rate)
+                if len(rates) >= settle_windows:
+                    # The peak of the backlog is taken on the mean of settle_windows windows, like the streaks
+                    peak_rate = max(peak_rate, sum(rates[-settle_windows:]) / settle_windows)
+                if streak and abs(rate - sum(streak) / len(streak)) <= tolerance * sum(streak) / len(streak):
+                    streak.append(rate)
+                else:
+                    # A new streak starts with this window
+                    streak = [rate]
+                    streak_start = window_start
+                window_start = now
+                window_bytes = 0
+                mean_rate = sum(streak) / len(streak)
+                below = (1 - tolerance) * peak_rate if live_rate is None else max((1 - tolerance) * peak_rate, (1 + tolerance) * live_rate)
+                if (len(streak) >= settle_windows and mean_rate <= below) or now - streak_start >= settle_time:
+                    reason = "settled"
+                    break
+
+        self.fifo_stats = {
+            "frames": frames,
+            "bytes": drained_bytes,
+            "seconds": time.monotonic() - start_time,
+            "reason": reason,
+            "live_rate": rates[-1] if rates else 0.0,
+        }
+        logger.info(f"Drained {frames} frames ({drained_bytes} bytes) from the FIFO in {self.fifo_stats['seconds']:.2f} s, "
+                    f"stop reason: {reason}, last rate {self.fifo_stats['live_rate']:.0f} B/s")
         logger.info("Starting clean up after empting fifo")        
         self.clean_up_fifo()
         logger.info("Empting fifo terminated")
+        return self.fifo_stats
 
 
     
 
-    def signal_integrity(self, duration=60): 
+    def signal_integrity(self, duration=60, threshold=1000, required_channels=4, min_events=1000, confidence=3.0): 
+        """
+        Checks that at least required_channels channels have a mean energy above threshold,
+        stopping as soon as the running per-channel statistics decide the result.
+        """
 
         self.start_connection()
         if not self.server:
             logger.error("Server is not initialized. Exiting run method.")
             return
         
+        self.phase = "integrity"
         poller = zmq.Poller()
         poller.register(self.server, zmq.POLLIN)  # Controlla se ci sono dati disponibili
         
-        energy_info = {ch : [] for ch in range(7)}
-       
+        stats = ChannelStats()
+        framer = EventFramer()
+        result = None
       
         start_time = time.time()
         logger.info("Starting the communication with the DMA")
-        while duration is None or time.time() - start_time < duration:
+        while result is None and (duration is None or time.time() - start_time < duration):
             socks = dict(poller.poll(timeout=5000))  
                 
             if self.server in socks and socks[self.server] == zmq.POLLIN:
                 try:
-                    message = self.server.recv_multipart()
+                    message = self.server.recv_multipart(copy=False)
                 except zmq.ZMQError as e: 
                     logger.error("Failed to receive messages: %s", e)
                     continue
                     
-                for part in message:
+                for part in message[1:]:
                     if len(part) != 1:
-                        l = int(len(part) / 2)
                         try:
-                            v = struct.unpack_from(f"{l}H", part)
-                        except Exception as ex:
-                            logger.error("Error in struct.unpack_from: %s", ex)
-                            continue 
-                            
-                        a = ""
-                        i = 0
-                        for b in v:
-                            value = f'{b:04x} ' 
-                            i += 1
-                            a += value
-                            if i % 8 == 0: 
-                                try:
-
-                                    self.process_signal_integrity(a.strip(), energy_info)
-                                    a = ""
-                                    i = 0
-                                except Exception as e:
-                                    logger.error(f"Some problems occured when putting the data in the queue: {e}")
+                            stats.update(decode_words(framer.push(frame_to_words(part.buffer))))
+                        except Exception as e:
+                            logger.error(f"Some problems occured decoding the received frame: {e}")
+
+                margin = confidence * stats.standard_error()
+                decided = stats.count >= min_events
+                passed = int(np.count_nonzero(decided & (stats.mean - margin > threshold)))
+                failed = int(np.count_nonzero(decided & (stats.mean + margin < threshold)))
+                if passed >= required_channels:
+                    result = True
+                elif failed > stats.n_channels - required_channels:
+                    result = False
             else:
                 logger.debug("No message received in 5 seconds. Continuing...")
 
-            
-        
-
-        energy_means = {ch: (sum(energy) / len(energy) if energy else 0) for ch, energy in energy_info.items()}
-        valid_channels = sum(1 for mean in energy_means.values() if mean > 1000)
-
-        if valid_channels >= 4:
-            logger.info(f"Signal integrity check PASSED: {valid_channels} channels have mean energy > 1000.")
-            logger.info("Starting clean up")        
-            self.clean_up()
-            logger.info("DataProcess.signal_integrity terminated")
-            return True
+        elapsed = time.time() - start_time
+        logger.info(f"Energy per channel after {elapsed:.1f} s: counts {stats.count.tolist()}, means {np.round(stats.mean, 1).tolist()}, "
+                    f"standard deviations {np.round(np.sqrt(stats.variance()), 1).tolist()}")
+        if result is None:
+            valid_channels = int(np.count_nonzero((stats.count > 0) & (stats.mean > threshold)))
+            result = valid_channels >= required_channels
         else:
-            logger.warning(f"Signal integrity check FAILED: only {valid_channels} channels have mean energy > 1000.")
-            logger.info("Starting clean up")        
-            self.clean_up()
-            logger.info("DataProcess.signal_integrity terminated")
-            return False
-
-        
-        
-
-    
-    def process_signal_integrity(self, event, data_save):
-
-        if not event:
-            logger.info("Empty event received. Skipping...")
-            return
-
-        event = self.string_no_space(event)
-        event_cut = event[4:-4]
-        if not event_cut: 
-            logger.info("The event received has no valuable data. Skipping...")
-            return 
-        
-        number_bits = len(event_cut) * 4
-        event_integer = int(event_cut, 16)
-        binary_string = bin(event_integer)[2:]
-        event_bit = binary_string.zfill(number_bits)
-        
-        try:
-            canale = int(event_bit[3:8],2)
-            energia = int(event_bit[74:88], 2)
-            
-            data_save[canale].append(energia)
-
-        except Exception as e:
-            logger.error(f"Error parsing event: {e}")
+            valid_channels = passed
+            logger.info(f"Signal integrity decided early after {elapsed:.1f} s")
 
+        if result:
+            logger.info(f"Signal integrity check PASSED: {valid_channels} channels have mean energy > {threshold}.")
+        else:
+            logger.warning(f"Signal integrity check FAILED: only {valid_channels} channels have mean energy > {threshold}.")
+        logger.info("Starting clean up")        
+        self.clean_up()
+        logger.info("DataProcess.signal_integrity terminated")
+        return result
 
 
 
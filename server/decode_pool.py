@@ -0,0 +1,93 @@
+import logging
+import multiprocessing as mp
+import queue
+
+import numpy as np
+
+from decoder import EVENT_DTYPE, EVENT_WORDS, decode_words, frame_to_words
+from validation import REJECT_DTYPE, validate_words
+
+
+logger = logging.getLogger("DataProcessing")
+
+
+def decode_worker(tasks, results):
+    """
+    Entry point of a decoder process: validates and decodes blocks of framed events until it
+    receives None. Every block is returned as (events, rejected events).
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        sequence, frames, check_crc = task
+        try:
+            words = np.concatenate([frame_to_words(frame) for frame in frames]).reshape(-1, EVENT_WORDS)
+            words, rejects = validate_words(words, check_crc=check_crc)
+            block = (decode_words(words), rejects)
+        except Exception as e:
+            logger.error(f"Decoder worker failed on block {sequence}: {e}")
+            block = (np.empty(0, dtype=EVENT_DTYPE), np.empty(0, dtype=REJECT_DTYPE))
+        results.put((sequence, block))
+
+
+class ShardedDecoder:
+    """
+    Pool of decoder processes. Blocks of frames holding whole events are numbered when submitted,
+    validated and decoded by any free worker and handed back strictly in submission order, so the
+    output stays in arrival order.
+
+    At most max_pending blocks are in flight: when the workers fall behind, submit() waits.
+    """
+
+    def __init__(self, workers=2, max_pending=None):
+        self.workers = workers
+        self.max_pending = max_pending or 4 * workers
+        self.tasks = mp.Queue(maxsize=self.max_pending)
+        self.results = mp.Queue()
+        self.processes = [mp.Process(target=decode_worker, args=(self.tasks, self.results), daemon=True) for _ in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.next_sequence = 0
+        self.next_ready = 0
+        self.reorder = {}
+        logger.info(f"Started {workers} decoder processes")
+
+    @property
+    def pending(self):
+        return self.next_sequence - self.next_ready
+
+    def submit(self, frames, check_crc=False):
+        """Hands a block of frames to the workers. Returns its sequence number"""
+        sequence = self.next_sequence
+        self.tasks.put((sequence, frames, check_crc))
+        self.next_sequence += 1
+        return sequence
+
+    def ready(self, wait=False):
+        """
+        Yields the (events, rejects) blocks that are next in sequence order. With wait=True it waits until
+        all the submitted blocks have been decoded.
+        """
+        while self.pending:
+            while self.next_ready in self.reorder:
+                yield self.reorder.pop(self.next_ready)
+                self.next_ready += 1
+            if not self.pending:
+                break
+            try:
+                sequence, block = self.results.get(block=wait, timeout=60 if wait else None)
+            except queue.Empty:
+                if wait:
+                    logger.error(f"Decoder workers did not return {self.pending} blocks")
+                break
+            self.reorder[sequence] = block
+
+    def close(self):
+        """Waits for the pending blocks, which are returned in order, and stops the workers"""
+        blocks = list(self.ready(wait=True))
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+        return blocks
@@ -0,0 +1,327 @@
+import logging
+import time
+
+import numpy as np
+
+
+logger = logging.getLogger("DataProcessing")
+
+# Number of 16-bit words sent by the evproducer for every event
+EVENT_WORDS = 8
+
+# Minimum number of events needed to learn the framing words from the stream
+LEARN_EVENTS = 16
+# Events looked at when learning, and fraction of them that must share the framing words at the same phase
+LEARN_MAX_EVENTS = 1024
+LEARN_FRACTION = 0.5
+
+# The coarse time counts the ticks of the front-end clock and every tick is split in TDC_BINS by
+# the 5-bit TDC time. The absolute timestamp is counted in TDC bins
+COARSE_CLOCK_HZ = 125_000_000
+TDC_BINS = 32
+TIMESTAMP_HZ = COARSE_CLOCK_HZ * TDC_BINS
+# Width of the coarse time field, and period of the counter if it does not restart every second
+COARSE_BITS = 28
+COARSE_PERIOD = 1 << COARSE_BITS
+# How the coarse time relates to the unix time (not confirmed on the front-end): "second" if it
+# restarts at every unix second, "free_running" if it counts on and wraps every COARSE_PERIOD ticks
+COARSE_MODE = "second"
+# Number of values of the 5-bit channel field
+CHANNEL_VALUES = 32
+# Words collected while trying to learn the framing words before giving up and assuming aligned data
+LEARN_MAX_WORDS = 64 * 1024
+
+# Fields decoded from each event, in the same order as the columns of the acquisition files
+EVENT_DTYPE = np.dtype([
+    ("channel", np.uint8),
+    ("unix_time_16", np.uint16),
+    ("coarse_time", np.uint32),
+    ("tdc_time", np.uint8),
+    ("tot_time", np.uint8),
+    ("tdc_trigger_end", np.uint8),
+    ("energy", np.uint16),
+    ("crc", np.uint8),
+    ("timestamp", np.uint64),
+])
+
+
+def frame_to_words(part):
+    """
+    Returns a uint16 view over a received frame, without copying it.
+    A trailing odd byte is ignored, as struct.unpack_from did.
+    """
+    buffer = memoryview(part)
+    nbytes = buffer.nbytes & ~1
+    return np.frombuffer(buffer, dtype=np.uint16, count=nbytes // 2)
+
+
+def decode_words(words):
+    """
+    Decodes a flat array of 16-bit words into an EVENT_DTYPE record array.
+    The timestamp field only holds the time within the unix second: the TimestampUnwrapper that
+    follows the stream adds the full unix time.
+
+    The words are grouped 8 by 8: the first and last word of every event are the framing words
+    and are not decoded, the 96 bits in between hold the event fields. Incomplete trailing
+    events are ignored.
+
+    Bit layout of the 96 payload bits (bit 0 is the most significant bit of word 1):
+        3:8     channel
+        8:24    unix time (16 bit)
+        24:32 + 33:53   coarse time (bit 32 is skipped)
+        53:59   ToT
+        59:64   TDC trigger end
+        69:74   TDC time
+        74:88   energy
+        88:96   CRC
+    """
+    words = np.asarray(words, dtype=np.uint16).ravel()
+    n_events = words.size // EVENT_WORDS
+    w = words[:n_events * EVENT_WORDS].reshape(n_events, EVENT_WORDS).astype(np.uint32)
+
+    w1, w2, w3, w4, w5, w6 = w[:, 1], w[:, 2], w[:, 3], w[:, 4], w[:, 5], w[:, 6]
+
+    events = np.empty(n_events, dtype=EVENT_DTYPE)
+    events["channel"] = (w1 >> 8) & 0x1F
+    events["unix_time_16"] = ((w1 & 0xFF) << 8) | (w2 >> 8)
+    events["coarse_time"] = ((w2 & 0xFF) << 20) | ((w3 & 0x7FFF) << 5) | (w4 >> 11)
+    events["tot_time"] = (w4 >> 5) & 0x3F
+    events["tdc_trigger_end"] = w4 & 0x1F
+    events["tdc_time"] = (w5 >> 6) & 0x1F
+    events["energy"] = ((w5 & 0x3F) << 8) | (w6 >> 8)
+    events["crc"] = w6 & 0xFF
+    events["timestamp"] = events["coarse_time"].astype(np.uint64) * TDC_BINS + events["tdc_time"]
+    return events
+
+
+def decode_frame(part):
+    """Decodes all the complete events contained in a single received frame"""
+    return decode_words(frame_to_words(part))
+
+
+class EventFramer:
+    """
+    Cuts the stream of 16-bit words received in successive message parts into 8-word events.
+
+    The words left over at the end of a part are carried over to the next one, so events split
+    across parts are recovered. Every event starts with the header word and ends with the trailer
+    word (the words process_data cuts off with event[4:-4]). When the parts are aligned, as the
+    evproducer normally sends them, whole blocks are cut with a reshape. Otherwise the framer
+    resynchronises on the positions where a header is followed by a trailer 7 words later and
+    discards the words in between. Whole events found between two resynchronisation points are
+    events with a corrupted header or trailer: they are kept aside, see take_rejects().
+
+    The header and trailer values can be given; by default they are learned from the first events,
+    as the only pair of columns that is constant along the stream. If no such pair is found the
+    stream is assumed to be aligned and only the carry-over is applied.
+    """
+
+    def __init__(self, header=None, trailer=None):
+        self.header = header
+        self.trailer = trailer
+        self.unframed = False
+        self.carry = np.empty(0, dtype=np.uint16)
+        self.events = 0
+        self.events_recovered = 0
+        self.events_discarded = 0
+        self.words_discarded = 0
+        self.rejects = []
+
+    def learn(self, words):
+        """
+        Looks for the phase where the first and last word of almost every event take the same value.
+        A few corrupted events among the first ones do not prevent learning.
+        """
+        n_events = min(words.size // EVENT_WORDS - 1, LEARN_MAX_EVENTS)
+        if n_events < LEARN_EVENTS:
+            return False
+        best = None
+        for phase in range(EVENT_WORDS):
+            body = words[phase:phase + n_events * EVENT_WORDS].reshape(n_events, EVENT_WORDS)
+            header_counts = np.bincount(body[:, 0])
+            trailer_counts = np.bincount(body[:, -1])
+            matched = min(header_counts.max(), trailer_counts.max())
+            if best is None or matched > best[0]:
+                best = (matched, int(header_counts.argmax()), int(trailer_counts.argmax()))
+        if best[0] < LEARN_FRACTION * n_events:
+            return False
+        _, self.header, self.trailer = best
+        logger.info(f"Learned the event framing words: header 0x{self.header:04x}, trailer 0x{self.trailer:04x}")
+        return True
+
+    def push(self, words):
+        """Adds the words of a message part. Returns the complete events as an (N, 8) uint16 array"""
+        words = np.asarray(words, dtype=np.uint16).ravel()
+        carried = self.carry.size
+        if carried:
+            words = np.concatenate((self.carry, words))
+
+        if self.header is None and not self.unframed and not self.learn(words):
+            if words.size < LEARN_MAX_WORDS:
+                self.carry = words.copy()
+                return np.empty((0, EVENT_WORDS), dtype=np.uint16)
+            logger.warning("Unable to learn the event framing words. Assuming aligned events")
+            self.unframed = True
+
+        n_events = words.size // EVENT_WORDS
+        body = words[:n_events * EVENT_WORDS].reshape(n_events, EVENT_WORDS)
+        if self.unframed or ((body[:, 0] == self.header).all() and (body[:, -1] == self.trailer).all()):
+            # The carry has to be copied, the words may be a view over a receive buffer
+            self.carry = words[n_events * EVENT_WORDS:].copy()
+            if carried and n_events:
+                self.events_recovered += 1
+            self.events += n_events
+            return body
+        return self.resync(words, carried)
+
+    def resync(self, words, carried):
+        candidates = np.flatnonzero((words[:-(EVENT_WORDS - 1)] == self.header) & (words[EVENT_WORDS - 1:] == self.trailer))
+        if candidates.size and (np.diff(candidates) < EVENT_WORDS).any():
+            # Overlapping candidates, a header value inside the payload: keep the first of each group
+            selected = []
+            next_free = 0
+            for position in candidates.tolist():
+                if position >= next_free:
+                    selected.append(position)
+                    next_free = position + EVENT_WORDS
+            candidates = np.array(selected, dtype=np.intp)
+
+        if candidates.size:
+            end = int(candidates[-1]) + EVENT_WORDS
+            # Words skipped before every event. A gap of whole events is kept as events with broken
+            # framing words, any other gap is discarded
+            gap_start = np.empty_like(candidates)
+            gap_start[0] = 0
+            gap_start[1:] = candidates[:-1] + EVENT_WORDS
+            gap = candidates - gap_start
+            broken = (gap > 0) & (gap % EVENT_WORDS == 0)
+            lost = (gap > 0) & ~broken
+            self.events_discarded += int(np.count_nonzero(lost))
+            self.words_discarded += int(gap[lost].sum())
+            if broken.any():
+                self.rejects.append(np.concatenate([
+                    words[start:stop].reshape(-1, EVENT_WORDS) for start, stop in zip(gap_start[broken].tolist(), candidates[broken].tolist())
+                ]))
+            # Events found off the regular grid of the part, or completed with carried words
+            self.events_recovered += int(np.count_nonzero((candidates < carried) | ((candidates - carried) % EVENT_WORDS != 0)))
+        else:
+            end = 0
+
+        # Only the last 7 words can still be the beginning of an event
+        tail = words.size - end
+        if tail >= EVENT_WORDS:
+            self.words_discarded += tail - (EVENT_WORDS - 1)
+            self.events_discarded += 1
+            end = words.size - (EVENT_WORDS - 1)
+        self.carry = words[end:].copy()
+        self.events += candidates.size
+        return words[candidates[:, None] + np.arange(EVENT_WORDS)]
+
+    def take_rejects(self):
+        """Returns the events with broken framing words found since the last call, as an (N, 8) uint16 array"""
+        if not self.rejects:
+            return np.empty((0, EVENT_WORDS), dtype=np.uint16)
+        rejects = self.rejects[0] if len(self.rejects) == 1 else np.concatenate(self.rejects)
+        self.rejects = []
+        return rejects
+
+    def finish(self):
+        """Accounts for the words left over at the end of the stream"""
+        if self.carry.size:
+            self.words_discarded += self.carry.size
+            self.events_discarded += 1
+            self.carry = np.empty(0, dtype=np.uint16)
+
+    def stats(self):
+        return {
+            "events": self.events,
+            "events_recovered": self.events_recovered,
+            "events_discarded": self.events_discarded,
+            "words_discarded": self.words_discarded,
+            "header": self.header,
+            "trailer": self.trailer,
+        }
+
+
+class TimestampUnwrapper:
+    """
+    Fills the 64-bit absolute timestamp of the decoded events, in units of 1 / TIMESTAMP_HZ
+    seconds since the unix epoch, so that events can be sorted and compared across channels.
+
+    The 16-bit unix time wraps every 18 hours. For every channel the full unix time is rebuilt as
+    the value closest to the last one seen on the same channel, starting from the host clock at
+    the beginning of the run: the host clock only has to be right within 9 hours. The unwrapping
+    is vectorised over whole blocks, which have to be passed in arrival order.
+
+    With coarse_mode "second" the coarse time is the time within the unix second. With
+    "free_running" the coarse counter is unwrapped: the unix time gives the elapsed time within
+    one second, less than half of the counter period, and the first event of the run is placed at
+    the start of its unix second. The events are checked against the mode: coarse times of a
+    second or more ("second" only) and timestamps going back on a channel are counted and
+    reported by stats().
+    """
+
+    def __init__(self, anchor=None, coarse_mode=COARSE_MODE):
+        self.anchor = time.time() if anchor is None else anchor
+        self.seconds = np.full(CHANNEL_VALUES, int(self.anchor), dtype=np.int64)
+        self.coarse_mode = coarse_mode
+        # Free running counter: absolute coarse ticks minus the unwrapped counter
+        self.origin = None
+        self.last = np.zeros(CHANNEL_VALUES, dtype=np.uint64)
+        self.coarse_overflow = np.zeros(CHANNEL_VALUES, dtype=np.int64)
+        self.backwards = np.zeros(CHANNEL_VALUES, dtype=np.int64)
+
+    def apply(self, events):
+        """Adds the full unix time to the timestamps of decoded events, in place. Returns the events"""
+        if not len(events):
+            return events
+        channel = events["channel"].astype(np.intp)
+        reference = self.seconds[channel]
+        # The difference of the 16-bit values, read as a signed 16-bit number, is the step closest to the reference
+        delta = (events["unix_time_16"] - reference.astype(np.uint16)).view(np.int16)
+        seconds = reference + delta
+        np.maximum.at(self.seconds, channel, seconds)
+
+        if self.coarse_mode == "free_running":
+            coarse = events["coarse_time"].astype(np.int64)
+            if self.origin is None:
+                self.origin = int(seconds[0]) * COARSE_CLOCK_HZ - int(coarse[0])
+            expected = seconds * COARSE_CLOCK_HZ - self.origin
+            ticks = coarse + np.round((expected - coarse) / COARSE_PERIOD).astype(np.int64) * COARSE_PERIOD + self.origin
+            events["timestamp"] = ticks.astype(np.uint64) * np.uint64(TDC_BINS) + events["tdc_time"]
+        else:
+            overflow = events["coarse_time"] >= COARSE_CLOCK_HZ
+            if overflow.any():
+                self.coarse_overflow += np.bincount(channel[overflow], minlength=CHANNEL_VALUES)
+            events["timestamp"] += seconds.astype(np.uint64) * np.uint64(TIMESTAMP_HZ)
+        self.check_order(events["channel"], events["timestamp"])
+        return events
+
+    def check_order(self, channel, timestamp):
+        """Counts the events older than the previous one of the same channel"""
+        # The stable sort of the 8-bit channels is a cheap radix sort
+        order = np.argsort(channel, kind="stable")
+        channel = channel[order]
+        timestamp = timestamp[order]
+        first = np.ones(len(channel), dtype=bool)
+        first[1:] = channel[1:] != channel[:-1]
+        previous = np.empty_like(timestamp)
+        previous[1:] = timestamp[:-1]
+        previous[first] = self.last[channel[first]]
+        backwards = timestamp < previous
+        if backwards.any():
+            self.backwards += np.bincount(channel[backwards], minlength=CHANNEL_VALUES)
+        last = np.append(first[1:], True)
+        self.last[channel[last]] = timestamp[last]
+
+    def stats(self):
+        """Counters of the events that do not fit the coarse time mode, with a warning if there are any"""
+        stats = {
+            "coarse_mode": self.coarse_mode,
+            "coarse_overflow": {channel: int(self.coarse_overflow[channel]) for channel in np.flatnonzero(self.coarse_overflow).tolist()},
+            "backwards": {channel: int(self.backwards[channel]) for channel in np.flatnonzero(self.backwards).tolist()},
+        }
+        if stats["coarse_overflow"] or stats["backwards"]:
+            logger.warning(f"The timestamps do not fit the coarse time mode \"{self.coarse_mode}\": coarse times of a second or more "
+                           f"per channel {stats['coarse_overflow']}, timestamps going back per channel {stats['backwards']}")
+        return stats
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+#coding=utf-8
+"""
+Synthetic evproducer: sends correctly formatted 8-word events to the DAQ receiver at a given
+rate, so that the acquisition chain can be run and measured without a multiPMT.
+
+The events carry the host time at which they are generated, so the latency of the chain can be
+measured on the decoded timestamps. Frames that cannot be queued because the receiver is not
+keeping up are dropped and counted, as the FIFO of the board would overflow.
+
+Usage: python evproducer_sim.py --port 5555 --rate 1e5 --frame-events 1024 --channels 0,1,2:0.5 --duration 10
+"""
+import argparse
+import time
+
+import numpy as np
+import zmq
+
+from decoder import COARSE_CLOCK_HZ, EVENT_WORDS, TDC_BINS
+from histograms import N_CHANNELS
+from validation import compute_crc
+
+
+# Framing words of the synthetic events. The receiver learns them from the stream
+SIM_HEADER = 0xA5A5
+SIM_TRAILER = 0x5A5A
+
+
+def encode_events(channel, unix_time, coarse_time, tdc_time, tot_time=0, tdc_trigger_end=0, energy=0, header=SIM_HEADER, trailer=SIM_TRAILER, crc=None):
+    """
+    Packs event fields in an (N, 8) uint16 array, with the bit layout read by decode_words().
+    The unused bits are zero. Without crc the CRC of every event is computed.
+    """
+    channel = np.asarray(channel, dtype=np.uint32)
+    unix_time = np.asarray(unix_time, dtype=np.uint32) & 0xFFFF
+    coarse_time = np.asarray(coarse_time, dtype=np.uint32)
+    n_events = len(channel)
+
+    words = np.empty((n_events, EVENT_WORDS), dtype=np.uint16)
+    words[:, 0] = header
+    words[:, 1] = ((channel & 0x1F) << 8) | (unix_time >> 8)
+    words[:, 2] = ((unix_time & 0xFF) << 8) | ((coarse_time >> 20) & 0xFF)
+    words[:, 3] = (coarse_time >> 5) & 0x7FFF
+    words[:, 4] = ((coarse_time & 0x1F) << 11) | ((np.asarray(tot_time, dtype=np.uint32) & 0x3F) << 5) | (np.asarray(tdc_trigger_end, dtype=np.uint32) & 0x1F)
+    energy = np.asarray(energy, dtype=np.uint32)
+    words[:, 5] = ((np.asarray(tdc_time, dtype=np.uint32) & 0x1F) << 6) | ((energy >> 8) & 0x3F)
+    words[:, 6] = (energy & 0xFF) << 8
+    words[:, 7] = trailer
+    words[:, 6] |= compute_crc(words) if crc is None else np.asarray(crc, dtype=np.uint16) & 0xFF
+    return words
+
+
+def parse_channels(text):
+    """Parses a channel mix like "0,1,2:0.5" (channel[:weight]) into normalised weights per channel"""
+    weights = np.zeros(N_CHANNELS)
+    for item in text.split(","):
+        channel, _, weight = item.partition(":")
+        weights[int(channel)] = float(weight) if weight else 1.0
+    return weights / weights.sum()
+
+
+class SyntheticProducer:
+    """
+    Sends events to the DAQ port over a DEALER socket, like the evproducer of a board.
+
+    Parameters:
+        rate (float): Events per second.
+        frame_events (int): Events per frame (message part).
+        channel_weights (array): Fraction of the events on every channel, uniform by default.
+        hwm (int): Frames queued in the socket before the following ones are dropped.
+    """
+
+    def __init__(self, host="127.0.0.1", port=5555, rate=1e5, frame_events=1024, channel_weights=None, hwm=1000, identity=None, seed=0):
+        self.address = f"tcp://{host}:{port}"
+        self.rate = rate
+        self.frame_events = frame_events
+        self.channel_weights = np.full(N_CHANNELS, 1 / N_CHANNELS) if channel_weights is None else np.asarray(channel_weights)
+        self.hwm = hwm
+        self.identity = identity
+        self.rng = np.random.default_rng(seed)
+
+    def make_frame(self, times):
+        """Events generated at the given host times, in seconds"""
+        n_events = len(times)
+        seconds = np.floor(times)
+        ticks = ((times - seconds) * COARSE_CLOCK_HZ * TDC_BINS).astype(np.int64)
+        return encode_events(
+            channel=self.rng.choice(N_CHANNELS, n_events, p=self.channel_weights),
+            unix_time=seconds.astype(np.int64),
+            coarse_time=ticks // TDC_BINS,
+            tdc_time=ticks % TDC_BINS,
+            tot_time=self.rng.integers(0, 64, n_events),
+            energy=self.rng.integers(0, 1 << 14, n_events),
+        ).tobytes()
+
+    def run(self, duration, stop=None):
+        """
+        Sends events for duration seconds, or until the stop event is set. Every frame is sent once
+        the time of its last event has come. Returns the statistics of the run.
+        """
+        context = zmq.Context()
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.SNDHWM, self.hwm)
+        socket.setsockopt(zmq.LINGER, 2000)
+        if self.identity:
+            socket.setsockopt(zmq.IDENTITY, self.identity)
+        socket.connect(self.address)
+
+        frames = 0
+        dropped = 0
+        late = 0
+        frame_time = self.frame_events / self.rate
+        offsets = np.arange(1, self.frame_events + 1) / self.rate
+        cpu_start = time.process_time()
+        start = time.time()
+        try:
+            while time.time() - start < duration and not (stop and stop.is_set()):
+                frame_start = start + (frames + dropped) * frame_time
+                wait = frame_start + frame_time - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                elif wait < -frame_time:
+                    late += 1
+                try:
+                    socket.send(self.make_frame(frame_start + offsets), zmq.NOBLOCK)
+                    frames += 1
+                except zmq.Again:
+                    dropped += 1
+        finally:
+            seconds = time.time() - start
+            cpu_time = time.process_time() - cpu_start
+            socket.close()
+            context.term()
+        return {"frames": frames, "events": frames * self.frame_events, "frames_dropped": dropped, "frames_late": late,
+                "seconds": seconds, "cpu_time": cpu_time}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send synthetic multiPMT events to the DAQ receiver")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="The host of the DAQ receiver")
+    parser.add_argument("--port", type=int, default=5555, help="The port of the DAQ receiver")
+    parser.add_argument("--rate", type=float, default=1e5, help="Events per second")
+    parser.add_argument("--frame-events", type=int, default=1024, help="Events per frame")
+    parser.add_argument("--channels", type=str, default=None, help="Channel mix as channel[:weight],... (default: all channels equally)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of sending")
+    args = parser.parse_args()
+    producer = SyntheticProducer(args.host, args.port, args.rate, args.frame_events, parse_channels(args.channels) if args.channels else None)
+    stats = producer.run(args.duration)
+    print(f"Sent {stats['events']} events in {stats['frames']} frames in {stats['seconds']:.1f} s "
+          f"({stats['events'] / stats['seconds']:.0f} events/s), {stats['frames_dropped']} frames dropped, "
+          f"CPU {100 * stats['cpu_time'] / stats['seconds']:.0f}%")
@@ -0,0 +1,113 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+
+
+logger = logging.getLogger("DataProcessing")
+
+N_CHANNELS = 7
+# Width in bits of the energy and ToT fields of an event
+ENERGY_BITS = 14
+TOT_BITS = 6
+
+
+class ChannelHistograms:
+    """
+    Fixed-bin histograms of energy and ToT for each channel, filled block by block during the
+    acquisition. Events with a channel number outside 0..n_channels-1 are only counted.
+    """
+
+    def __init__(self, energy_bin_width=16, tot_bin_width=1, n_channels=N_CHANNELS):
+        self.n_channels = n_channels
+        self.energy_bin_width = energy_bin_width
+        self.tot_bin_width = tot_bin_width
+        self.energy_bins = -(-(1 << ENERGY_BITS) // energy_bin_width)
+        self.tot_bins = -(-(1 << TOT_BITS) // tot_bin_width)
+        self.energy = np.zeros((n_channels, self.energy_bins), dtype=np.int64)
+        self.tot = np.zeros((n_channels, self.tot_bins), dtype=np.int64)
+        self.out_of_range = 0
+
+    def update(self, events):
+        if not len(events):
+            return
+        channel = events["channel"].astype(np.intp)
+        valid = channel < self.n_channels
+        if not valid.all():
+            self.out_of_range += int(len(valid) - np.count_nonzero(valid))
+            events = events[valid]
+            channel = channel[valid]
+
+        # A single bincount fills all the channels: the index of an event is channel * bins + bin
+        index = channel * self.energy_bins + events["energy"] // self.energy_bin_width
+        self.energy += np.bincount(index, minlength=self.energy.size).reshape(self.energy.shape)
+        index = channel * self.tot_bins + events["tot_time"] // self.tot_bin_width
+        self.tot += np.bincount(index, minlength=self.tot.size).reshape(self.tot.shape)
+
+    def counts(self):
+        return self.energy.sum(axis=1)
+
+    def save(self, path):
+        """Saves the histograms and their bin edges in a .npz file"""
+        path = Path(path)
+        np.savez(
+            path,
+            energy=self.energy,
+            tot=self.tot,
+            energy_edges=np.arange(self.energy_bins + 1) * self.energy_bin_width,
+            tot_edges=np.arange(self.tot_bins + 1) * self.tot_bin_width,
+            out_of_range=self.out_of_range,
+        )
+        logger.info(f"Histograms saved in {path}. Events per channel: {self.counts().tolist()}")
+        return path
+
+    @staticmethod
+    def path_for(data_path):
+        """Path of the histograms saved next to an acquisition file"""
+        data_path = Path(data_path)
+        return data_path.with_name(f"{data_path.stem}_hist.npz")
+
+
+class ChannelStats:
+    """
+    Running count, mean and variance of the energy of each channel, in constant memory.
+    Every decoded block is reduced per channel with bincount and merged into the running values
+    with the parallel variance formula (Chan et al.).
+    """
+
+    def __init__(self, n_channels=N_CHANNELS):
+        self.n_channels = n_channels
+        self.count = np.zeros(n_channels, dtype=np.int64)
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+
+    def update(self, events):
+        if not len(events):
+            return
+        channel = events["channel"].astype(np.intp)
+        valid = channel < self.n_channels
+        if not valid.all():
+            events = events[valid]
+            channel = channel[valid]
+        energy = events["energy"].astype(np.float64)
+
+        count = np.bincount(channel, minlength=self.n_channels)
+        present = count > 0
+        mean = np.zeros(self.n_channels)
+        mean[present] = np.bincount(channel, weights=energy, minlength=self.n_channels)[present] / count[present]
+        m2 = np.bincount(channel, weights=(energy - mean[channel]) ** 2, minlength=self.n_channels)
+
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean = np.where(present, self.mean + delta * count / total, self.mean)
+            self.m2 = np.where(present, self.m2 + m2 + delta ** 2 * self.count * count / total, self.m2)
+        self.count = total
+
+    def variance(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), 0.0)
+
+    def standard_error(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.variance() / self.count), np.inf)
@@ -1,6 +1,11 @@
-from pylablib.devices import Thorlabs
 import logging
 
+try:
+    from pylablib.devices import Thorlabs
+except ImportError:
+    # Only the simulated backends (simulated_instruments.py) can be used without pylablib
+    Thorlabs = None
+
 
 
 logger = logging.getLogger("Wheels")
@@ -29,6 +34,10 @@ class Wheels:
             logger.error(f"Unable to retrieve info from device on port {self.port}: {e}")
             raise
 
+    def check(self):
+        """Health check: queries the current position, raises if the wheel does not answer"""
+        return self.wheel.get_position()
+
     def go_to_position(self, position):
         try:
             current_pos = self.wheel.get_position()
@@ -69,6 +78,10 @@ class Polarizer:
             logger.error(f"Unable to retrieve info from device on port {self.port}: {e}")
             raise
 
+    def check(self):
+        """Health check: queries the current position, raises if the stage does not answer"""
+        return float(self.stepper.get_position(scale=True))
+
     def go_to_position(self, position):
         position = float(position)
         current_position = float(self.stepper.get_position(scale=True))
@@ -84,6 +97,38 @@ class Polarizer:
             logger.error(f"Unable to change position of the device on port {self.port}: {e}")
             raise
     
+    def start_move(self, position, velocity=None):
+        """
+        Starts a move without waiting for it to end. With velocity (degrees per second) the maximum
+        velocity of the stage is changed first. Returns the velocity parameters in use before.
+        """
+        previous = self.stepper.get_velocity_parameters(scale=True)
+        try:
+            if velocity is not None:
+                self.stepper.setup_velocity(max_velocity=velocity, scale=True)
+            self.stepper.move_to(float(position), scale=True)
+            logger.info(f"Polarizer moving to {position} at {velocity or previous.max_velocity} deg/s")
+        except Exception as e:
+            logger.error(f"Unable to start the move of the device on port {self.port}: {e}")
+            # The caller does not get the previous parameters to restore them
+            if velocity is not None:
+                try:
+                    self.restore_velocity(previous)
+                except Exception as restore_error:
+                    logger.error(f"Unable to restore the velocity of the device on port {self.port}: {restore_error}")
+            raise
+        return previous
+
+    def is_moving(self):
+        return self.stepper.is_moving()
+
+    def wait_move(self, timeout=None):
+        self.stepper.wait_move(timeout=timeout)
+
+    def restore_velocity(self, parameters):
+        """Sets back the velocity parameters returned by start_move()"""
+        self.stepper.setup_velocity(parameters.min_velocity, parameters.acceleration, parameters.max_velocity, scale=True)
+
     def close(self):
         """Release the polarizer resources"""
         try:
@@ -0,0 +1,150 @@
+"""
+Continuous-sweep calibration of the polarizer.
+
+The stage rotates at constant speed while a single acquisition runs. A PositionSampler thread
+reads the position of the stage with the host time of every reading. At the end of the run every
+event gets the angle of the stage at its timestamp, interpolated between the readings, and the
+events are binned by angle. Before the first reading and after the last one the stage is at rest,
+so the angle is the one of the first and last reading.
+
+The timestamps of the events follow the unix time of the board and are moved to the host clock
+by clock_offset (host minus board, in seconds). It is estimated from the run with
+clock_offset_from_latency(), unless it is known.
+"""
+import logging
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from decoder import TIMESTAMP_HZ
+from histograms import N_CHANNELS
+from writers import read_events
+
+
+logger = logging.getLogger("Server")
+
+# Seconds between two readings of the stage position
+SAMPLE_INTERVAL = 0.02
+# Step in seconds of the time grid used to compute the time spent in every angle bin
+EXPOSURE_STEP = 0.001
+
+
+class PositionSampler:
+    """
+    Reads the position of an instrument on a background thread every interval seconds. Every
+    reading is stamped with the host time halfway through the query.
+    """
+
+    def __init__(self, read_position, interval=SAMPLE_INTERVAL):
+        self.read_position = read_position
+        self.interval = interval
+        self.times = []
+        self.positions = []
+        self.errors = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="position-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.is_set():
+            before = time.time()
+            try:
+                position = float(self.read_position())
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Failed to read the position: {e}")
+            else:
+                after = time.time()
+                self.times.append(0.5 * (before + after))
+                self.positions.append(position)
+            self.stop_event.wait(max(0.0, self.interval - (time.time() - before)))
+
+    def wait_for(self, position, tolerance=0.05, timeout=None):
+        """Waits until a reading is within tolerance of position. Returns False on timeout"""
+        start = time.time()
+        while not (self.positions and abs(self.positions[-1] - position) <= tolerance):
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(self.interval)
+        return True
+
+    def stop(self):
+        """Stops the sampling. Returns the host times and the positions read"""
+        self.stop_event.set()
+        self.thread.join()
+        return np.array(self.times), np.array(self.positions)
+
+
+def clock_offset_from_latency(latency):
+    """
+    Host minus board clock offset estimated from the latency stats of a run (see
+    FrameConsumer.latency_stats): the smallest latency, the offset plus the shortest transfer and
+    decoding delay, a few ms at most. None without latency measurements.
+    """
+    return latency.get("min") if latency else None
+
+
+def event_angles(timestamps, sample_times, sample_angles, clock_offset=0.0):
+    """Angle of the stage at the timestamps of the events (in 1 / TIMESTAMP_HZ units of the board)"""
+    seconds = np.asarray(timestamps, dtype=np.float64) / TIMESTAMP_HZ + clock_offset
+    return np.interp(seconds, sample_times, sample_angles)
+
+
+def exposure(start, end, sample_times, sample_angles, bin_edges):
+    """Seconds spent by the stage in every angle bin between the host times start and end"""
+    grid = np.arange(start, end, EXPOSURE_STEP)
+    counts, _ = np.histogram(np.interp(grid, sample_times, sample_angles), bins=bin_edges)
+    return counts * EXPOSURE_STEP
+
+
+def bin_sweep(path, sample_times, sample_angles, bin_width=1.0, clock_offset=0.0, chunk_size=1_000_000):
+    """
+    Tags the events of a .npy acquisition file with the angle of the stage, saved in
+    <stem>_angle.npy, and bins them by angle. The counts, mean energies and rates of every bin
+    and channel are saved in <stem>_angles.npz. Returns the path of the .npz file.
+    """
+    path = Path(path)
+    events = read_events(path)
+    low = np.floor(sample_angles.min() / bin_width) * bin_width
+    high = max(low + bin_width, np.ceil(sample_angles.max() / bin_width) * bin_width)
+    bin_edges = np.arange(low, high + 0.5 * bin_width, bin_width)
+    n_bins = len(bin_edges) - 1
+    counts = np.zeros((n_bins, N_CHANNELS), dtype=np.int64)
+    energy = np.zeros((n_bins, N_CHANNELS), dtype=np.float64)
+    first = last = None
+
+    angles = np.lib.format.open_memmap(path.with_name(f"{path.stem}_angle.npy"), mode="w+", dtype=np.float32, shape=(len(events),))
+    for start in range(0, len(events), chunk_size):
+        chunk = np.asarray(events[start:start + chunk_size])
+        timestamp = np.ascontiguousarray(chunk["timestamp"])
+        angle = event_angles(timestamp, sample_times, sample_angles, clock_offset)
+        angles[start:start + len(chunk)] = angle
+        if not len(chunk):
+            continue
+        first = timestamp.min() if first is None else min(first, timestamp.min())
+        last = timestamp.max() if last is None else max(last, timestamp.max())
+        channel = np.ascontiguousarray(chunk["channel"]).astype(np.intp)
+        valid = channel < N_CHANNELS
+        index = np.clip(np.searchsorted(bin_edges, angle[valid], side="right") - 1, 0, n_bins - 1) * N_CHANNELS + channel[valid]
+        counts += np.bincount(index, minlength=n_bins * N_CHANNELS).reshape(n_bins, N_CHANNELS)
+        energy += np.bincount(index, weights=chunk["energy"][valid], minlength=n_bins * N_CHANNELS).reshape(n_bins, N_CHANNELS)
+    angles.flush()
+    del angles
+
+    if first is None:
+        seconds = np.zeros(n_bins)
+    else:
+        seconds = exposure(first / TIMESTAMP_HZ + clock_offset, last / TIMESTAMP_HZ + clock_offset, sample_times, sample_angles, bin_edges)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_energy = np.where(counts > 0, energy / counts, np.nan)
+        rates = np.where(seconds[:, None] > 0, counts / seconds[:, None], np.nan)
+    output = path.with_name(f"{path.stem}_angles.npz")
+    np.savez(output, bin_edges=bin_edges, counts=counts, mean_energy=mean_energy, seconds=seconds, rates=rates,
+             sample_times=sample_times, sample_angles=sample_angles, clock_offset=clock_offset)
+    logger.info(f"Binned {int(counts.sum())} events of {path} in {n_bins} bins of {bin_width} deg")
+    return output
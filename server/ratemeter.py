@@ -0,0 +1,88 @@
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+from decoder import EVENT_WORDS
+from histograms import N_CHANNELS
+
+
+# Length in seconds of the time buckets and number of buckets kept, i.e. the longest window
+RATE_BUCKET = 1.0
+RATE_SLOTS = 64
+EVENT_BYTES = 2 * EVENT_WORDS
+
+
+class RateMeter:
+    """
+    Per-channel event rates and received byte rates over sliding windows.
+
+    The counts are accumulated in buckets of RATE_BUCKET seconds kept in a circular table. The
+    table can live in shared memory (see shared_buffer()), so that the rates filled by the consumer
+    process can be read by the process that runs the acquisition while it is recording.
+    """
+
+    def __init__(self, buffer=None, n_channels=N_CHANNELS, slots=RATE_SLOTS, bucket=RATE_BUCKET):
+        self.n_channels = n_channels
+        self.slots = slots
+        self.bucket = bucket
+        # Every row: bucket number, received bytes, events of every channel
+        columns = n_channels + 2
+        if buffer is None:
+            self.table = np.frombuffer(RateMeter.shared_buffer(n_channels, slots), dtype=np.int64).reshape(slots, columns)
+            self.reset()
+        else:
+            self.table = np.frombuffer(buffer, dtype=np.int64).reshape(slots, columns)
+            self.started = time.time()
+
+    @staticmethod
+    def shared_buffer(n_channels=N_CHANNELS, slots=RATE_SLOTS):
+        """Allocates the table in shared memory, to be passed to the RateMeter of another process"""
+        return mp.RawArray("q", slots * (n_channels + 2))
+
+    def reset(self):
+        self.table[:] = 0
+        self.table[:, 0] = -1
+        self.started = time.time()
+
+    def row(self, now):
+        number = int(now / self.bucket)
+        row = self.table[number % self.slots]
+        if row[0] != number:
+            row[1:] = 0
+            row[0] = number
+        return row
+
+    def update(self, events, now=None):
+        """Counts the decoded events of a block"""
+        if not len(events):
+            return
+        row = self.row(time.time() if now is None else now)
+        counts = np.bincount(events["channel"], minlength=self.n_channels)
+        row[2:] += counts[:self.n_channels]
+
+    def add_bytes(self, nbytes, now=None):
+        """Counts the bytes of a received frame"""
+        row = self.row(time.time() if now is None else now)
+        row[1] += nbytes
+
+    def rates(self, window=10.0, now=None):
+        """
+        Returns the event rate of every channel, the corresponding byte rate and the rate of received
+        bytes, averaged over the complete buckets of the last window seconds.
+        """
+        now = time.time() if now is None else now
+        current = int(now / self.bucket)
+        n_buckets = max(1, min(int(window / self.bucket), self.slots - 1))
+        # Buckets before the start of the acquisition do not count
+        n_buckets = max(1, min(n_buckets, current - int(self.started / self.bucket)))
+        table = self.table.copy()
+        selected = (table[:, 0] >= current - n_buckets) & (table[:, 0] < current)
+        seconds = n_buckets * self.bucket
+        events = table[selected, 2:].sum(axis=0) / seconds
+        return {
+            "window": seconds,
+            "events": events.tolist(),
+            "bytes": (events * EVENT_BYTES).tolist(),
+            "received_bytes": float(table[selected, 1].sum() / seconds),
+        }
@@ -0,0 +1,130 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Default size of the data region of the ring, in bytes
+DEFAULT_RING_SIZE = 64 * 1024 * 1024
+
+# Layout of the control block placed at the beginning of the shared memory (uint64 slots)
+HEAD = 0            # Total bytes published by the producer
+TAIL = 1            # Total bytes released by the consumer
+FRAMES_WRITTEN = 2
+FRAMES_DROPPED = 3
+BYTES_DROPPED = 4
+HIGH_WATER = 5      # Maximum number of bytes in use
+OCCUPANCY_SUM = 6   # Sum of the bytes in use sampled at every write, to compute the mean occupancy
+CONTROL_SLOTS = 8
+CONTROL_SIZE = CONTROL_SLOTS * 8
+
+# Every frame is stored as an 8-byte length prefix followed by the payload padded to 8 bytes
+RECORD_HEADER = 8
+WRAP_MARKER = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def _padded(nbytes):
+    return (nbytes + 7) & ~7
+
+
+class FrameRing:
+    """
+    Single-producer single-consumer ring of variable-length frames in shared memory.
+
+    The receiver process copies every frame in the ring with write() and never waits: when the
+    ring is full the frame is dropped and counted as an overrun. The consumer process attaches to
+    the same ring by name, reads the frames in order with read() and gives the space back with
+    release(). The producer only moves HEAD and the consumer only moves TAIL.
+    """
+
+    def __init__(self, size=DEFAULT_RING_SIZE, name=None):
+        self.capacity = _padded(size)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=CONTROL_SIZE + self.capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.control = np.ndarray((CONTROL_SLOTS,), dtype=np.uint64, buffer=self.shm.buf)
+        self.data = np.ndarray((self.capacity,), dtype=np.uint8, buffer=self.shm.buf, offset=CONTROL_SIZE)
+        if self.owner:
+            self.control[:] = 0
+        self.pending = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def used(self):
+        return int(self.control[HEAD] - self.control[TAIL])
+
+    def write(self, frame):
+        """Copies a frame in the ring. Returns False if the frame was dropped because the ring is full"""
+        payload = np.frombuffer(frame, dtype=np.uint8)
+        nbytes = payload.size
+        record = RECORD_HEADER + _padded(nbytes)
+        head = int(self.control[HEAD])
+        position = head % self.capacity
+        skip = self.capacity - position if position + record > self.capacity else 0
+        used = head - int(self.control[TAIL])
+
+        if used + skip + record > self.capacity:
+            self.control[FRAMES_DROPPED] += 1
+            self.control[BYTES_DROPPED] += nbytes
+            return False
+
+        if skip:
+            self.data[position:position + RECORD_HEADER].view(np.uint64)[0] = WRAP_MARKER
+            position = 0
+        self.data[position:position + RECORD_HEADER].view(np.uint64)[0] = nbytes
+        self.data[position + RECORD_HEADER:position + RECORD_HEADER + nbytes] = payload
+
+        used += skip + record
+        self.control[FRAMES_WRITTEN] += 1
+        self.control[OCCUPANCY_SUM] += used
+        if used > self.control[HIGH_WATER]:
+            self.control[HIGH_WATER] = used
+        # Publishing the new head is the last step, the consumer never sees a partial frame
+        self.control[HEAD] = head + skip + record
+        return True
+
+    def read(self):
+        """
+        Returns a view over the oldest frame in the ring, or None if the ring is empty.
+        The view is valid until release() is called.
+        """
+        self.release()
+        tail = int(self.control[TAIL])
+        if tail == int(self.control[HEAD]):
+            return None
+        position = tail % self.capacity
+        nbytes = self.data[position:position + RECORD_HEADER].view(np.uint64)[0]
+        skip = 0
+        if nbytes == WRAP_MARKER:
+            skip = self.capacity - position
+            position = 0
+            nbytes = self.data[:RECORD_HEADER].view(np.uint64)[0]
+        nbytes = int(nbytes)
+        self.pending = skip + RECORD_HEADER + _padded(nbytes)
+        return self.data[position + RECORD_HEADER:position + RECORD_HEADER + nbytes]
+
+    def release(self):
+        """Gives back to the producer the space of the last frame returned by read()"""
+        if self.pending:
+            self.control[TAIL] += self.pending
+            self.pending = 0
+
+    def stats(self):
+        frames = int(self.control[FRAMES_WRITTEN])
+        return {
+            "capacity": self.capacity,
+            "frames_written": frames,
+            "frames_dropped": int(self.control[FRAMES_DROPPED]),
+            "bytes_dropped": int(self.control[BYTES_DROPPED]),
+            "high_water": int(self.control[HIGH_WATER]),
+            "mean_occupancy": int(self.control[OCCUPANCY_SUM]) / frames if frames else 0.0,
+        }
+
+    def close(self):
+        del self.control, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,193 @@
+"""
+Ordering of the instrument configurations visited by a measurement, to minimise the time spent
+moving the wheels and the polarizer.
+
+A configuration is a dictionary of instrument positions, like {"near_wheel": 7, "far_wheel": 8}.
+The instruments move at the same time (see InstrumentsManager.move_all), so going from one
+configuration to the next costs the slowest of the moves. The move times come from per-instrument
+models, measured on the hardware with measure_motion_models() and saved in MOTION_MODELS_PATH.
+
+Full grids are visited in serpentine order, so that only one instrument moves by one step between
+consecutive configurations, any other set in nearest-neighbour order. Every candidate order is
+evaluated with the models and the fastest one is returned.
+"""
+import itertools
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+
+logger = logging.getLogger("Server")
+
+MOTION_MODELS_PATH = Path("/swgo") / "multiPMT" / "motion_models.json"
+# Above this number of configurations the nearest-neighbour order is only tried from the first one
+NEAREST_NEIGHBOUR_STARTS = 64
+
+
+class MotionModel:
+    """
+    Move time of an instrument: a fixed overhead plus a time per unit of travel (wheel position or
+    degree). A wheel with n_positions positions turns the shortest way around.
+    """
+
+    def __init__(self, overhead, per_unit, n_positions=None):
+        self.overhead = overhead
+        self.per_unit = per_unit
+        self.n_positions = n_positions
+
+    def distance(self, start, end):
+        distance = abs(end - start)
+        if self.n_positions:
+            distance = min(distance, self.n_positions - distance)
+        return distance
+
+    def time(self, start, end):
+        if start is None:
+            # Unknown starting position: the worst case
+            return self.overhead + self.per_unit * (self.n_positions // 2 if self.n_positions else 0)
+        if start == end:
+            return 0.0
+        return self.overhead + self.per_unit * self.distance(start, end)
+
+    def to_dict(self):
+        return {"overhead": self.overhead, "per_unit": self.per_unit, "n_positions": self.n_positions}
+
+    def __repr__(self):
+        return f"MotionModel(overhead={self.overhead:.3f} s, per_unit={self.per_unit:.3f} s, n_positions={self.n_positions})"
+
+
+# Rough models used until the hardware has been measured
+default_motion_models = {
+    "near_wheel": MotionModel(0.5, 0.5, n_positions=12),
+    "far_wheel": MotionModel(0.5, 0.5, n_positions=12),
+    "polarizer": MotionModel(0.5, 0.1),
+}
+
+
+def load_motion_models(path=MOTION_MODELS_PATH):
+    """The measured models saved in path, the default ones for the instruments not measured"""
+    models = dict(default_motion_models)
+    path = Path(path)
+    if path.exists():
+        with open(path) as f:
+            models.update({name: MotionModel(**model) for name, model in json.load(f).items()})
+    return models
+
+
+def save_motion_models(models, path=MOTION_MODELS_PATH):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({name: model.to_dict() for name, model in models.items()}, f, indent=2)
+    return path
+
+
+def measure_motion_models(manager, targets=None, path=MOTION_MODELS_PATH):
+    """
+    Measures the move time of the instruments over a range of distances and fits the models,
+    which are saved in path. targets gives the sequence of positions visited by every instrument.
+    All the instruments move at the same time, each one is timed on its own.
+    """
+    models = load_motion_models(path)
+    if targets is None:
+        # Moves of 1, 2, ... positions, up to half a turn
+        n_positions = models["near_wheel"].n_positions
+        wheel = [1]
+        for step in range(1, n_positions // 2 + 1):
+            wheel.append((wheel[-1] - 1 + step) % n_positions + 1)
+        targets = {"near_wheel": wheel, "far_wheel": wheel, "polarizer": [0, 5, 15, 35, 75, 155, 0]}
+
+    samples = {name: [] for name in targets}
+    for step in range(max(len(sequence) for sequence in targets.values())):
+        positions = {name: sequence[step] for name, sequence in targets.items() if step < len(sequence)}
+        start = {name: manager.positions.get(name) for name in positions}
+        times = manager.move_all(positions)
+        for name, seconds in times.items():
+            if start[name] is not None and start[name] != positions[name]:
+                samples[name].append((models[name].distance(start[name], positions[name]), seconds))
+
+    for name, points in samples.items():
+        distances, seconds = np.array(points, dtype=float).reshape(-1, 2).T
+        if len(np.unique(distances)) < 2:
+            logger.warning(f"Not enough different moves to model the {name}")
+            continue
+        per_unit, overhead = np.polyfit(distances, seconds, 1)
+        models[name] = MotionModel(max(0.0, float(overhead)), max(0.0, float(per_unit)), models[name].n_positions)
+        logger.info(f"Motion model of the {name}: {models[name]}")
+    save_motion_models(models, path)
+    return models
+
+
+def transition_time(start, end, models):
+    """Time to go from one configuration to the next, with all the instruments moving at the same time"""
+    return max((models[name].time(None if start is None else start.get(name), position) for name, position in end.items()), default=0.0)
+
+
+def total_time(order, models, start=None):
+    times = [transition_time(previous, config, models) for previous, config in zip([start] + order[:-1], order)]
+    return sum(times)
+
+
+def grid_axes(configs):
+    """
+    The positions of every instrument if the configurations are the full grid of their values,
+    None otherwise. Instruments with a single position are left out.
+    """
+    names = list(configs[0])
+    values = {name: sorted({config[name] for config in configs}) for name in names}
+    if any(set(config) != set(names) for config in configs):
+        return None
+    n_grid = int(np.prod([len(positions) for positions in values.values()]))
+    if n_grid != len(configs) or n_grid != len({tuple(config[name] for name in names) for config in configs}):
+        return None
+    return {name: positions for name, positions in values.items() if len(positions) > 1}, {name: positions[0] for name, positions in values.items() if len(positions) == 1}
+
+
+def serpentine_orders(axes, fixed):
+    """Every serpentine order of the grid: any instrument as the outer one, any starting corner"""
+    names = list(axes)
+    for permutation in itertools.permutations(names):
+        for reversed_axes in itertools.product([False, True], repeat=len(names)):
+            order = [dict(fixed)]
+            for name, reverse in zip(permutation, reversed_axes):
+                positions = axes[name][::-1] if reverse else axes[name]
+                order = [dict(prefix, **{name: position}) for i, prefix in enumerate(order) for position in (positions if i % 2 == 0 else positions[::-1])]
+            yield order
+
+
+def nearest_neighbour_order(configs, models, start=None):
+    """Greedy order: always the configuration reachable in the shortest time"""
+    remaining = list(configs)
+    order = []
+    current = start
+    while remaining:
+        index = min(range(len(remaining)), key=lambda i: transition_time(current, remaining[i], models))
+        current = remaining.pop(index)
+        order.append(current)
+    return order
+
+
+def plan_scan(configs, start=None, models=None):
+    """
+    Orders the configurations to minimise the total motion time, starting from the current
+    positions start (a configuration, None if unknown). Returns the order and its estimated time.
+    """
+    configs = [dict(config) for config in configs]
+    if not configs:
+        return [], 0.0
+    models = models or load_motion_models()
+    candidates = [configs]
+    grid = grid_axes(configs)
+    if grid:
+        candidates.extend(serpentine_orders(*grid))
+    if start is not None or len(configs) > NEAREST_NEIGHBOUR_STARTS:
+        candidates.append(nearest_neighbour_order(configs, models, start))
+    else:
+        for i, first in enumerate(configs):
+            candidates.append([first] + nearest_neighbour_order(configs[:i] + configs[i + 1:], models, first))
+    best = min(candidates, key=lambda order: total_time(order, models, start))
+    estimate = total_time(best, models, start)
+    logger.info(f"Scan of {len(best)} configurations: estimated motion time {estimate:.1f} s, {total_time(configs, models, start):.1f} s in the given order")
+    return best, estimate
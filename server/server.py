@@ -5,10 +5,16 @@ import zmq
 import argparse
 import logging
 import json
+import os
+import threading
 import time
 import HardwareResources
 from InstrumentManager import InstrumentsManager
-from data_processing import DataProcess
+from polarizer_sweep import PositionSampler, bin_sweep, clock_offset_from_latency
+from scan_planner import measure_motion_models, plan_scan
+from boards import DAQ_BASE_PORT, BoardReceivers
+from capture import CAPTURE_OUTPUT
+from writers import flush_policies, output_backends
 
 
 #Generic Constants
@@ -17,6 +23,11 @@ MAX_RETRIES = 3
 #ZMQ Constants
 POLLER_TIMEOUT_CONNECTION = 20000 #in ms
 
+#DAQ Constants
+DECODE_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 2)) #Decoder processes used during the acquisitions
+COINCIDENCE_WINDOW = 100 #Coincidence window in ns used by the wheels and polarizer measurements
+SWEEP_MARGIN = 10 #Seconds added to the acquisition of a polarizer sweep for the acceleration of the stage
+
 
 ##################################
 # LOGGER
@@ -47,8 +58,11 @@ class Server(cmd2.Cmd):
         super().__init__()
         self.server = None
         self.clients_connected = []  
+        self.daq_ports = {}
         self.instrument_manager = InstrumentsManager(self.poutput)
         self.batch = None
+        self.daq = None
+        self.acquisition = None
 
 
     
@@ -113,7 +127,10 @@ class Server(cmd2.Cmd):
 
             self.poutput("Connection established successfully")
 
-            self.server.send_multipart([client_id, b"EV"])
+            # Every multiPMT sends its events to its own receiver. The port is sent only when it is not
+            # the default one of the evproducer, so a single multiPMT starts it as before
+            daq_port = self.daq_ports.setdefault(client_id, DAQ_BASE_PORT + len(self.daq_ports))
+            self.server.send_multipart([client_id, b"EV"] + ([str(daq_port).encode()] if daq_port != DAQ_BASE_PORT else []))
             socks = dict(poller.poll(POLLER_TIMEOUT_CONNECTION * 30)) #Wait 10 minutes to let the client set evproducer and the high voltage
             if self.server not in socks:
                 self.poutput("Timeout in attesa della risposta EV.")
@@ -166,11 +183,30 @@ class Server(cmd2.Cmd):
             return False
 
 
+    def _acquisition_running(self):
+        """
+        True, with a message, while an acquisition runs in the background: it uses the socket of
+        the multiPMTs and the receivers, which cannot be shared with another thread, so only the
+        rates command can be used until it ends
+        """
+        if self.acquisition and self.acquisition.is_alive():
+            self.poutput("An acquisition is running in the background: only the rates command can be used until it ends")
+            return True
+        return False
+
     def _clean_up(self):
         """
         Clean up funtion to realise all the resources
         """
+        if self.acquisition and self.acquisition.is_alive():
+            self.poutput("Waiting for the acquisition running in the background to finish")
+            self.acquisition.join()
+        self.instrument_manager.close()
         self.clients_connected.clear()
+        self.daq_ports.clear()
+        if self.daq:
+            self.daq.close()
+            self.daq = None
         if self.server:
             self.server.close()
         context.term()
@@ -185,6 +221,10 @@ class Server(cmd2.Cmd):
     def _init_polarizer(self, pol_position):
         self.instrument_manager.init_polarizer(pol_position)
 
+    def _set_instruments(self, near_wheel_pos=None, far_wheel_pos=None, pol_position=None):
+        """Moves the wheels and the polarizer at the same time. Returns the move time of every instrument"""
+        return self.instrument_manager.configure(near_wheel_pos, far_wheel_pos, pol_position)
+
     ###############################
     # RC
     ###############################
@@ -227,10 +267,13 @@ class Server(cmd2.Cmd):
     # DAQ
     ###############################
 
-    def _acquire_charge(self, suffix, flag_acq, run_id = None, timer=60):     
-        charge = DataProcess()
-        HardwareResources.DMACommunication(socket=self.server, clients=self.clients_connected, charge=charge, suffix=suffix, flag_acquisition=flag_acq, 
-                                           run_id=run_id, timer=timer, batch=self.batch, output_func=self.poutput)
+    def _acquire_charge(self, suffix, flag_acq, run_id = None, timer=60, output="npy", flush_policy=None, coincidence_window=None, coincidence_groups=False, check_crc=False):     
+        if self.daq is None:
+            # The receivers are bound once and reused by all the following acquisitions, one per multiPMT
+            self.daq = BoardReceivers(self.daq_ports or {b"multiPMT": DAQ_BASE_PORT}, decode_workers=DECODE_WORKERS)
+        return HardwareResources.DMACommunication(socket=self.server, clients=self.clients_connected, charge=self.daq, suffix=suffix, flag_acquisition=flag_acq, 
+                                           run_id=run_id, timer=timer, batch=self.batch, output_func=self.poutput, output=output, flush_policy=flush_policy,
+                                           coincidence_window=coincidence_window, coincidence_groups=coincidence_groups, check_crc=check_crc)
 
 
 
@@ -268,11 +311,15 @@ class Server(cmd2.Cmd):
         time.sleep(0.1)
         self._rc_write(16, 400)
         time.sleep(0.1)
-        for i in range(start_angle, start_angle+ampl, step):
+        # The angles are visited starting from the end closest to the current position of the polarizer
+        order, estimate = plan_scan([{"polarizer": i} for i in range(start_angle, start_angle+ampl, step)], start=self.instrument_manager.positions)
+        self.poutput(f"Visiting {len(order)} polarizer angles, estimated motion time {estimate:.0f} s")
+        for config in order:
+            i = config["polarizer"]
             try:
                 self._init_polarizer(i)
                 time.sleep(0.1)
-                self._acquire_charge(suffix=str(i), timer=time_acq, flag_acq = "polarizer", run_id=run_id)
+                self._acquire_charge(suffix=str(i), timer=time_acq, flag_acq = "polarizer", run_id=run_id, coincidence_window=COINCIDENCE_WINDOW)
                 time.sleep(0.1)
 
             except Exception as e:
@@ -287,10 +334,86 @@ class Server(cmd2.Cmd):
 
     
 
+    def _sweep_polarizer(self, end_angle, speed, sweep, finished):
+        """
+        Waits for the recording to start, then turns the polarizer to end_angle at speed deg/s while
+        its position is sampled. The readings are stored in sweep["samples"].
+        """
+        while not (self.daq and self.daq.recording()):
+            if finished.wait(0.05):
+                return
+        polarizer = self.instrument_manager.device("polarizer")
+        previous = polarizer.start_move(end_angle, velocity=speed)
+        # Only the sampler talks to the stage while it moves
+        sampler = PositionSampler(polarizer.check).start()
+        try:
+            if not sampler.wait_for(end_angle, timeout=abs(end_angle - self.instrument_manager.positions.get("polarizer", 0)) / speed + SWEEP_MARGIN):
+                self.poutput("The polarizer did not reach the end of the sweep in time")
+        finally:
+            sweep["samples"] = sampler.stop()
+            polarizer.restore_velocity(previous)
+            self.instrument_manager.positions["polarizer"] = polarizer.check()
+
+    def _calib_polarizer_sweep(self, start_angle=0, ampl=110, speed=1.0, near_w=10, far_w=6, voltage_ch=1200, bin_width=1.0, run_id = "pol_sweep", clock_offset=None):
+        """
+        Function to calibrate the polarizer in a single acquisition, while the stage turns at constant
+        speed. The events are tagged with the angle of the stage and binned by angle at the end.
+        clock_offset (host minus board clock, in s) is estimated from the latency of the run if None.
+        """
+        end_angle = start_angle + ampl
+        self._set_instruments(near_w, far_w, start_angle)
+        self._set_voltage(channels="all", voltage=voltage_ch)
+        time.sleep(0.1)
+        self._rc_write(15, 2)
+        time.sleep(0.1)
+        self._rc_write(18, 7250)
+        time.sleep(0.1)
+        self._rc_write(16, 400)
+        time.sleep(0.1)
+
+        sweep = {}
+        finished = threading.Event()
+        sweeper = threading.Thread(target=self._sweep_polarizer, args=(end_angle, speed, sweep, finished), daemon=True)
+        sweeper.start()
+        try:
+            paths = self._acquire_charge(suffix=f"sweep_{start_angle}_{end_angle}", timer=int(ampl / speed) + SWEEP_MARGIN, flag_acq="polarizer",
+                                         run_id=run_id, coincidence_window=COINCIDENCE_WINDOW)
+        except Exception as e:
+            self.poutput(f"Problem occured during the sweep of the polarizer: {e}")
+            paths = None
+        finally:
+            finished.set()
+            sweeper.join()
+
+        if "samples" not in sweep or not len(sweep["samples"][0]):
+            self.poutput("The polarizer sweep did not take place: no angle to tag the events with")
+        else:
+            sample_times, sample_angles = sweep["samples"]
+            self.poutput(f"Read {len(sample_times)} positions of the polarizer from {sample_angles[0]:.2f} to {sample_angles[-1]:.2f} deg")
+            for board, path in (paths or {}).items():
+                offset = clock_offset
+                if offset is None:
+                    offset = clock_offset_from_latency(self.daq.run_stats.get(board, {}).get("latency"))
+                    if offset is None:
+                        self.poutput(f"No latency measured for {board}: the board and host clocks are assumed synchronised")
+                        offset = 0.0
+                    else:
+                        self.poutput(f"Clock offset of {board} estimated from the latency: {offset:.3f} s ({speed * offset:.2f} deg)")
+                try:
+                    self.poutput(f"Angle bins of {board} saved in {bin_sweep(path, sample_times, sample_angles, bin_width, offset)}")
+                except Exception as e:
+                    self.poutput(f"Problem occured binning the events of {board} by angle: {e}")
+
+        self._rc_write(15, 0)
+        time.sleep(0.1)
+        self._rc_write(18, 0)
+        time.sleep(0.1)
+        self._rc_write(16, 0)
+        time.sleep(0.1)
+
     def _spe_pmt(self, pol_angle = 50, near_w = 6, far_w = 10, voltage_ch = 1200, time_acq = 60, run_id="spe"):
         """Fnction to acquire SPE spectrum for PMTs"""
-        self._init_wheels(near_w, far_w)
-        self._init_polarizer(pol_angle)
+        self._set_instruments(near_w, far_w, pol_angle)
         self._rc_write(15, 2)
         time.sleep(0.1)
         self._rc_write(18, 7250)
@@ -315,8 +438,7 @@ class Server(cmd2.Cmd):
     
     def _gain_pmt(self, pol_angle = 50, near_w = 6, far_w = 8, volt_start = 800, volt_end = 1400, deltav = 50, time_acq = 30, run_id = "gain"):
         """Function to acquire gain spectrum from PMTs"""
-        self._init_wheels(near_w, far_w)
-        self._init_polarizer(pol_angle)
+        self._set_instruments(near_w, far_w, pol_angle)
         self._rc_write(15, 2)
         time.sleep(0.1)
         self._rc_write(18, 7250)
@@ -358,14 +480,18 @@ class Server(cmd2.Cmd):
         time.sleep(0.1)
         
         
-        for i in range(near_start, 13):
-            for j in range(far_start, 13):
-                self._init_wheels(i, j)
-                time.sleep(0.1)
-                try:
-                    self._acquire_charge(suffix = f"wheels_{i}_{j}", flag_acq="wheels_char", run_id=run_id, timer=time_acq)
-                except Exception as e:
-                    self.poutput(f"Problem occurred during the wheels characterisation: {e}")
+        # Serpentine order over the grid of wheel positions, so that the wheels never travel back to the start of a row
+        configs = [{"near_wheel": i, "far_wheel": j} for i in range(near_start, 13) for j in range(far_start, 13)]
+        order, estimate = plan_scan(configs, start=self.instrument_manager.positions)
+        self.poutput(f"Visiting {len(order)} wheel positions, estimated motion time {estimate:.0f} s")
+        for config in order:
+            i, j = config["near_wheel"], config["far_wheel"]
+            self._init_wheels(i, j)
+            time.sleep(0.1)
+            try:
+                self._acquire_charge(suffix = f"wheels_{i}_{j}", flag_acq="wheels_char", run_id=run_id, timer=time_acq, coincidence_window=COINCIDENCE_WINDOW)
+            except Exception as e:
+                self.poutput(f"Problem occurred during the wheels characterisation: {e}")
 
         self._rc_write(15, 0)
         time.sleep(0.1)
@@ -390,12 +516,18 @@ class Server(cmd2.Cmd):
         Usage: connect <client_ip>
         Example: connect 172.16.24.249
         """
+        if self._acquisition_running():
+            return
 
         self._start_connection(args.port)
         if self._handshake(int(args.num_clients)):
             self.poutput(f"Connection with all the multiPMTs on port {args.port} was successful")
             self.prompt = f"|MultiPMT>"
             self.batch = args.batch
+            if self.daq:
+                # The receivers are opened again for the boards now connected
+                self.daq.close()
+                self.daq = None
         else:
             self.poutput(f"Something went wrong during the handshake with the multiPMTs ")
 
@@ -404,6 +536,8 @@ class Server(cmd2.Cmd):
         """
         Quit from the application and restart client
         """
+        if self._acquisition_running():
+            return
         if self.server:
             command_exit = {
                 "type": "client_command",
@@ -432,6 +566,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_argparser(wheels_parser)
     @cmd2.with_category("Instruments")
     def do_wheels(self, args: argparse.Namespace):
+        if self._acquisition_running():
+            return
         self._init_wheels(args.near_wheel_pos, args.far_wheel_pos)
 
     polarizer_parser = argparse.ArgumentParser()
@@ -440,8 +576,39 @@ class Server(cmd2.Cmd):
     @cmd2.with_argparser(polarizer_parser)
     @cmd2.with_category("Instruments")
     def do_polarizer(self, args: argparse.Namespace):
+        if self._acquisition_running():
+            return
         self._init_polarizer(args.pol_pos)
 
+    motion_parser = argparse.ArgumentParser()
+
+    @cmd2.with_argparser(motion_parser)
+    @cmd2.with_category("Instruments")
+    def do_measure_motion(self, args: argparse.Namespace):
+        """Measures the move times of the wheels and of the polarizer, used to order the scans"""
+        if self._acquisition_running():
+            return
+        try:
+            models = measure_motion_models(self.instrument_manager)
+        except Exception as e:
+            self.poutput(f"Problem occurred measuring the move times: {e}")
+            return
+        for name, model in models.items():
+            self.poutput(f"{name}: {model}")
+
+    instruments_parser = argparse.ArgumentParser()
+    instruments_parser.add_argument("--near", type=int, default=None, help="Position of the near wheel")
+    instruments_parser.add_argument("--far", type=int, default=None, help="Position of the far wheel")
+    instruments_parser.add_argument("--pol", type=float, default=None, help="Position of the polarizer")
+
+    @cmd2.with_argparser(instruments_parser)
+    @cmd2.with_category("Instruments")
+    def do_instruments(self, args: argparse.Namespace):
+        """Moves the selected instruments at the same time and shows the move time of each one"""
+        if self._acquisition_running():
+            return
+        self._set_instruments(args.near, args.far, args.pol)
+
     ############
     # RC
     ############
@@ -454,6 +621,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_category("RC")
     def do_write(self, args: argparse.Namespace) -> None:
         "Function to write user specified values in the Run Control registers"
+        if self._acquisition_running():
+            return
         self._rc_write(args.rc_write_addr, args.rc_write_value)
     
     ############
@@ -476,6 +645,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_category("HV")
     def do_set_init_conf(self, args: argparse.Namespace) -> None:
         "Function to set an initial configuration to the HV boards for the channel selected"
+        if self._acquisition_running():
+            return
         self._set_init_conf(args.channels, args.port, args.voltage_set, args.threshold_set, args.limit_trip_time, args.limit_voltage, args.limit_current, args.limit_temperature, args.rate_up, args.rate_down)
 
     hv_set_voltage_set = argparse.ArgumentParser()
@@ -487,6 +658,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_category("HV")
     def do_set_voltage(self, args: argparse.Namespace) -> None:
         "Function to set the voltage set to the HV boards for the channels selected"
+        if self._acquisition_running():
+            return
         self._set_voltage(args.channels, args.voltage_set, args.port)
 
     hv_on = argparse.ArgumentParser()
@@ -497,6 +670,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_category("HV")
     def do_on(self, args: argparse.Namespace) -> None:
         "Function to power on all or selected channels"
+        if self._acquisition_running():
+            return
         self._pwr_on(args.channels, args.port)
 
 
@@ -508,6 +683,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_category("HV")
     def do_hv_calibration(self, args: argparse.Namespace) -> None:
         "Function to calibrate all the HV boards connected"
+        if self._acquisition_running():
+            return
         self._hv_calib(args.channels, args.port)
 
     ############
@@ -519,12 +696,45 @@ class Server(cmd2.Cmd):
     daq_charge.add_argument("suffix", type=str, help="The suffix to put to characterize specific files")
     daq_charge.add_argument("flag", type=str, help="The flag of the acquisition type")
     daq_charge.add_argument("run_id", type=str, help="The run id")
+    daq_charge.add_argument("--output", type=str, default="npy", choices=list(output_backends) + [CAPTURE_OUTPUT], help="The output format of the acquisition file (raw: undecoded frames)")
+    daq_charge.add_argument("--flush", type=str, default=None, choices=list(flush_policies), help="The policy used to flush the acquisition file (default: by size or every second)")
+    daq_charge.add_argument("--coincidence", type=float, default=None, help="Search the coincidences between channels within this window in ns")
+    daq_charge.add_argument("--groups", action="store_true", help="Save also the events of every coincidence")
+    daq_charge.add_argument("--crc", action="store_true", help="Check the CRC of every event and reject the events failing it")
+    daq_charge.add_argument("--background", action="store_true", help="Run the acquisition in the background, so that its rates can be checked with the rates command")
 
     @cmd2.with_argparser(daq_charge)
     @cmd2.with_category("DAQ")
     def do_acquire(self, args: argparse.Namespace) -> None:
         """Function to acquire the charges from the channels that are on"""
-        self._acquire_charge(suffix=args.suffix, timer=args.timer, flag_acq=args.flag, run_id=args.run_id)
+        if self._acquisition_running():
+            return
+        acquisition_args = dict(suffix=args.suffix, timer=args.timer, flag_acq=args.flag, run_id=args.run_id, output=args.output, flush_policy=args.flush,
+                                coincidence_window=args.coincidence, coincidence_groups=args.groups, check_crc=args.crc)
+        if args.background:
+            self.acquisition = threading.Thread(target=self._acquire_charge, kwargs=acquisition_args, daemon=True)
+            self.acquisition.start()
+            self.poutput("Acquisition started in the background. Use the rates command to follow it")
+        else:
+            self._acquire_charge(**acquisition_args)
+
+    rates_parser = argparse.ArgumentParser()
+    rates_parser.add_argument("--window", type=float, default=10, help="The time window in seconds over which the rates are averaged")
+
+    @cmd2.with_argparser(rates_parser)
+    @cmd2.with_category("DAQ")
+    def do_rates(self, args: argparse.Namespace) -> None:
+        """Shows the event and byte rates of every channel in the acquisition running in the background (or in the last one)"""
+        if self.daq is None:
+            self.poutput("No acquisition has been started yet")
+            return
+        for board, rates in self.daq.rates(args.window).items():
+            self.poutput(f"{board}: rates over the last {rates['window']:.0f} s (DAQ phase: {rates['phase']})")
+            self.poutput(f"{'Channel':>8} {'Events/s':>12} {'kB/s':>10}")
+            for channel, (events, nbytes) in enumerate(zip(rates["events"], rates["bytes"])):
+                warning = "  <- no events" if events == 0 and any(rates["events"]) else ""
+                self.poutput(f"{channel:>8} {events:>12.1f} {nbytes / 1e3:>10.1f}{warning}")
+            self.poutput(f"{'Total':>8} {sum(rates['events']):>12.1f} {rates['received_bytes'] / 1e3:>10.1f} (received)")
 
     ############
     # ACQ
@@ -543,14 +753,38 @@ class Server(cmd2.Cmd):
     @cmd2.with_argparser(pol_parser)
     @cmd2.with_category("ACQ")
     def do_polarizer_acq(self, args: argparse.Namespace) -> None:
+        if self._acquisition_running():
+            return
         self._calib_polarizer(args.start_angle, args.step_angle, args.period_angle, args.near_w, args.far_w, args.voltage_ch, args.timer_acq, args.run_id)
 
 
+    sweep_parser = argparse.ArgumentParser()
+    sweep_parser.add_argument("start_angle", type=int, help="The initial angle of the polarizer")
+    sweep_parser.add_argument("period_angle", type=int, help="The angle covered by the sweep")
+    sweep_parser.add_argument("speed", type=float, help="The rotation speed of the polarizer in deg/s")
+    sweep_parser.add_argument("near_w", type=int, help="The position of the near wheel")
+    sweep_parser.add_argument("far_w", type=int, help="The position of the far wheel")
+    sweep_parser.add_argument("voltage_ch", type=int, help="The voltage of the channel")
+    sweep_parser.add_argument("run_id", type=str, help="The run id")
+    sweep_parser.add_argument("--bin", type=float, default=1.0, help="The width in degrees of the angle bins")
+    sweep_parser.add_argument("--clock-offset", type=float, default=None, help="The host minus board clock offset in s (default: estimated from the latency of the run)")
+
+    @cmd2.with_argparser(sweep_parser)
+    @cmd2.with_category("ACQ")
+    def do_polarizer_sweep(self, args: argparse.Namespace) -> None:
+        """Calibrates the polarizer in a single acquisition while the stage turns at constant speed"""
+        if self._acquisition_running():
+            return
+        self._calib_polarizer_sweep(args.start_angle, args.period_angle, args.speed, args.near_w, args.far_w, args.voltage_ch, args.bin, args.run_id, args.clock_offset)
+
+
     pedestal_parser = argparse.ArgumentParser()
 
     @cmd2.with_argparser(pedestal_parser)
     @cmd2.with_category("ACQ")
     def do_pedestal(self, args: argparse.Namespace) -> None:
+        if self._acquisition_running():
+            return
         self._pedestal()
 
 
@@ -568,6 +802,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_argparser(spe_parser)
     @cmd2.with_category("ACQ")
     def do_spe_acq(self, args: argparse.Namespace) -> None:
+        if self._acquisition_running():
+            return
         self._spe_pmt(args.pol_angle, args.near_w, args.far_w, args.voltage_ch, args.timer_acq, args.run_id)
 
 
@@ -586,6 +822,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_argparser(gain_parser)
     @cmd2.with_category("ACQ")
     def do_gain_acq(self, args: argparse.Namespace) -> None:
+        if self._acquisition_running():
+            return
         self._gain_pmt(args.pol_angle, args.near_w, args.far_w, args.voltage_start, args.voltage_end, args.voltage_step, args.timer_acq, args.run_id)
 
     wheels_parser = argparse.ArgumentParser()
@@ -599,6 +837,8 @@ class Server(cmd2.Cmd):
     @cmd2.with_argparser(wheels_parser)
     @cmd2.with_category("ACQ")
     def do_wheels_char(self, args: argparse.Namespace) -> None:
+        if self._acquisition_running():
+            return
         self._wheels_characterisation(args.pol_angle, args.near_start, args.far_start, args.voltage_channels, args.timer_acq, args.run_id)
 
 
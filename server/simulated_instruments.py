@@ -0,0 +1,182 @@
+"""
+Simulated Thorlabs filter wheels and Kinesis polarizer stage, drop-in replacements of
+instruments.Wheels and instruments.Polarizer that need neither pylablib nor the optical bench.
+
+The moves take the time of the motion models of scan_planner: a fixed overhead plus a time per
+wheel position, or the travel of the stage at its velocity, with a random jitter. time_scale
+shortens every wait, to run long sequences quickly. Failures are injected at random with the
+given probabilities: on opening, on a position query (a failed health check) and on a move.
+
+The state of every simulated instrument is kept per port, so an instrument opened again after a
+failure is where it was left, like the hardware. Select them in INSTRUMENTS_CONFIG_PATH, see
+InstrumentManager.load_instrument_ports().
+"""
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+
+
+logger = logging.getLogger("Wheels")
+
+# Same fields as the velocity parameters of pylablib.devices.Thorlabs.KinesisMotor
+TVelocityParams = namedtuple("TVelocityParams", ["min_velocity", "acceleration", "max_velocity"])
+
+# Position and velocity of the simulated instruments => "port" : state
+states = {}
+# Number of times every simulated instrument has been opened => "port" : count
+opened = {}
+states_lock = threading.Lock()
+
+
+class SimulatedInstrumentError(Exception):
+    pass
+
+
+class SimulatedInstrument:
+    def __init__(self, port, overhead, jitter=0.05, time_scale=1.0, open_failure=0.0, check_failure=0.0, move_failure=0.0, seed=None):
+        self.port = port
+        self.overhead = overhead
+        self.jitter = jitter
+        self.time_scale = time_scale
+        self.check_failure = check_failure
+        self.move_failure = move_failure
+        with states_lock:
+            opened[port] = opened.get(port, 0) + 1
+            # Every instrument, and every opening of it, draws its own jitter and failures
+            self.random = random.Random(None if seed is None else f"{seed}:{port}:{opened[port]}")
+        self.closed = False
+        self.fail(open_failure, "open")
+
+    def state(self, **initial):
+        with states_lock:
+            return states.setdefault(self.port, initial)
+
+    def fail(self, probability, action):
+        if self.closed:
+            raise SimulatedInstrumentError(f"Device on port {self.port} is closed")
+        if probability and self.random.random() < probability:
+            raise SimulatedInstrumentError(f"Simulated failure on {action} of the device on port {self.port}")
+
+    def move_time(self, seconds):
+        """Duration of a move of nominal duration seconds, with the jitter, in simulated seconds"""
+        return max(0.0, seconds * (1 + self.random.gauss(0, self.jitter)))
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.time_scale)
+
+    def close(self):
+        self.closed = True
+        logger.info(f"Simulated device on port {self.port} closed.")
+
+
+class SimulatedWheels(SimulatedInstrument):
+    """Filter wheel with n_positions positions (1 to n_positions) that turns the shortest way around"""
+
+    def __init__(self, port, overhead=0.5, per_position=0.5, n_positions=12, **options):
+        super().__init__(port, overhead, **options)
+        self.per_position = per_position
+        self.n_positions = n_positions
+        self.current = self.state(position=1)
+        logger.info(f"Simulated wheel initialized on port {port}")
+
+    def device_info(self):
+        return (f"Simulated FW on {self.port}", self.n_positions, self.check())
+
+    def check(self):
+        self.fail(self.check_failure, "position query")
+        return self.current["position"]
+
+    def go_to_position(self, position):
+        current_pos = self.check()
+        if not 1 <= position <= self.n_positions:
+            raise SimulatedInstrumentError(f"Position {position} out of the range of the wheel on port {self.port}")
+        if position != current_pos:
+            distance = abs(position - current_pos)
+            distance = min(distance, self.n_positions - distance)
+            seconds = self.move_time(self.overhead + self.per_position * distance)
+            if self.move_failure and self.random.random() < self.move_failure:
+                # The wheel stops halfway through the move
+                self.sleep(seconds / 2)
+                raise SimulatedInstrumentError(f"Simulated failure on move of the device on port {self.port}")
+            self.sleep(seconds)
+            self.current["position"] = position
+            logger.info(f"Simulated wheel on port {self.port} moved to position {position}")
+
+
+class SimulatedPolarizer(SimulatedInstrument):
+    """
+    Rotation stage moving at max_velocity degrees per second after overhead seconds. The position
+    is computed from the time since the start of the move, so it can be read while the stage turns.
+    """
+
+    def __init__(self, port, overhead=0.5, velocity=10.0, acceleration=10.0, **options):
+        super().__init__(port, overhead, **options)
+        self.current = self.state(position=0.0, velocity=TVelocityParams(0.0, acceleration, velocity), move=None)
+        logger.info(f"Simulated polarizer initialized on port {port}")
+
+    def device_info(self):
+        return (f"Simulated stage on {self.port}", self.check(), {"velocity": self.current["velocity"].max_velocity})
+
+    def position(self):
+        """Position at this time, the end of the move when it is over"""
+        move = self.current["move"]
+        if move is None:
+            return self.current["position"]
+        start, target, begin, end = move
+        now = time.time()
+        if now >= end:
+            self.current["position"] = target
+            self.current["move"] = None
+            return target
+        moving = begin + self.overhead * self.time_scale
+        if now <= moving:
+            return start
+        return start + (target - start) * (now - moving) / (end - moving)
+
+    def check(self):
+        self.fail(self.check_failure, "position query")
+        return float(self.position())
+
+    def get_velocity_parameters(self):
+        return self.current["velocity"]
+
+    def start_move(self, position, velocity=None):
+        previous = self.current["velocity"]
+        if velocity is not None:
+            self.current["velocity"] = previous._replace(max_velocity=float(velocity))
+        try:
+            self.fail(self.move_failure, "move")
+        except SimulatedInstrumentError:
+            # Like Polarizer.start_move, the previous velocity is restored before raising
+            self.current["velocity"] = previous
+            raise
+        start = self.position()
+        position = float(position)
+        seconds = self.move_time(self.overhead + abs(position - start) / self.current["velocity"].max_velocity)
+        begin = time.time()
+        self.current["move"] = (start, position, begin, begin + seconds * self.time_scale)
+        logger.info(f"Simulated polarizer moving to {position} at {self.current['velocity'].max_velocity} deg/s")
+        return previous
+
+    def is_moving(self):
+        self.position()
+        return self.current["move"] is not None
+
+    def wait_move(self, timeout=None):
+        start = time.time()
+        while self.is_moving():
+            if timeout is not None and time.time() - start > timeout:
+                raise SimulatedInstrumentError(f"Timeout waiting for the move of the device on port {self.port}")
+            time.sleep(0.001)
+
+    def restore_velocity(self, parameters):
+        self.current["velocity"] = TVelocityParams(*parameters)
+
+    def go_to_position(self, position):
+        position = float(position)
+        if position != self.check():
+            self.start_move(position)
+            self.wait_move()
+            logger.info(f"Simulated polarizer in {self.position()} position")
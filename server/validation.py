@@ -0,0 +1,204 @@
+import logging
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from decoder import CHANNEL_VALUES, EVENT_WORDS
+from histograms import N_CHANNELS
+from writers import NpyEventWriter
+
+
+logger = logging.getLogger("DataProcessing")
+
+# CRC-8 assumed for the front-end over the 88 payload bits that precede the CRC field, most
+# significant bit first, with initial value 0 and no final XOR. The definition is not confirmed
+CRC_POLY = 0x07
+# The CRC check costs about 40% of the decoding time: it is done only on request, until the CRC
+# definition of the front-end is confirmed
+CHECK_CRC = False
+# Fraction of CRC errors in the first events above which the CRC definition is considered wrong
+CRC_MAX_MISMATCH = 0.5
+
+# Reasons why an event is rejected, combined as bit flags
+REJECT_CRC = 1
+REJECT_FRAMING = 2
+REJECT_CHANNEL = 4
+
+# Rejected events are stored with their raw words, so they can be decoded again once understood
+REJECT_DTYPE = np.dtype([
+    ("words", np.uint16, (EVENT_WORDS,)),
+    ("reason", np.uint8),
+])
+
+
+def crc8_bits(bits, poly=CRC_POLY):
+    """Bitwise CRC-8 of a sequence of bits, most significant first"""
+    crc = 0
+    for bit in bits:
+        feedback = ((crc >> 7) & 1) ^ bit
+        crc = (crc << 1) & 0xFF
+        if feedback:
+            crc ^= poly
+    return crc
+
+
+@lru_cache(maxsize=None)
+def crc8_tables(poly=CRC_POLY):
+    """
+    Lookup tables of the contribution of each payload word to the CRC.
+
+    With initial value 0 the CRC is linear, so the CRC of an event is the XOR of the CRCs of its
+    payload words taken one at a time: a table of 65536 entries for each of the words 1 to 5 and of
+    256 entries for the high byte of word 6.
+    """
+    n_bits = 5 * 16 + 8
+    # CRC of the payload with a single bit set, for every bit position
+    basis = np.array([crc8_bits([int(i == position) for i in range(n_bits)], poly) for position in range(n_bits)], dtype=np.uint8)
+
+    tables = []
+    for first_bit, width in [(0, 16), (16, 16), (32, 16), (48, 16), (64, 16), (80, 8)]:
+        values = np.arange(1 << width, dtype=np.uint32)
+        table = np.zeros(1 << width, dtype=np.uint8)
+        for bit in range(width):
+            set_bits = ((values >> (width - 1 - bit)) & 1).astype(bool)
+            table[set_bits] ^= basis[first_bit + bit]
+        tables.append(table)
+    return tables
+
+
+def compute_crc(words, poly=CRC_POLY):
+    """Computes the CRC of every event of an (N, 8) uint16 array"""
+    tables = crc8_tables(poly)
+    # np.take on contiguous columns is much faster than fancy indexing on strided ones
+    columns = np.ascontiguousarray(words[:, 1:7].T)
+    np.right_shift(columns[5], 8, out=columns[5])
+    crc = np.take(tables[0], columns[0])
+    contribution = np.empty_like(crc)
+    for table, column in zip(tables[1:], columns[1:]):
+        np.take(table, column, out=contribution)
+        crc ^= contribution
+    return crc
+
+
+def crc_mismatch(words):
+    return compute_crc(words) != (words[:, 6] & 0xFF)
+
+
+def validate_words(words, n_channels=N_CHANNELS, check_crc=CHECK_CRC, framing_rejects=None):
+    """
+    Checks the channel number, and with check_crc the CRC, of the framed events of an (N, 8) uint16 array.
+    Returns the valid events and a REJECT_DTYPE array with the other ones. The events with broken
+    framing words given in framing_rejects are added to the rejects.
+    """
+    channel_error = ((words[:, 1] >> 8) & 0x1F) >= n_channels
+    if check_crc:
+        bad = crc_mismatch(words) | channel_error
+    else:
+        bad = channel_error
+    bad = np.flatnonzero(bad)
+    if framing_rejects is None:
+        framing_rejects = np.empty((0, EVENT_WORDS), dtype=np.uint16)
+
+    rejects = np.empty(len(bad) + len(framing_rejects), dtype=REJECT_DTYPE)
+    rejects["words"][:len(bad)] = words[bad]
+    rejects["words"][len(bad):] = framing_rejects
+    rejects["reason"][:len(bad)] = 0
+    rejects["reason"][len(bad):] = REJECT_FRAMING
+    if len(rejects):
+        rejected = rejects["words"]
+        if check_crc:
+            rejects["reason"][crc_mismatch(rejected)] |= REJECT_CRC
+        rejects["reason"][((rejected[:, 1] >> 8) & 0x1F) >= n_channels] |= REJECT_CHANNEL
+    if len(bad):
+        words = np.delete(words, bad, axis=0)
+    return words, rejects
+
+
+class RejectWriter(NpyEventWriter):
+    """Stores the rejected events of an acquisition in a .npy file next to the data file"""
+
+    dtype = REJECT_DTYPE
+
+    @staticmethod
+    def path_for(data_path):
+        """Path of the reject file of an acquisition file"""
+        data_path = Path(data_path)
+        return data_path.with_name(f"{data_path.stem}_reject.{NpyEventWriter.extension}")
+
+
+class EventValidator:
+    """
+    Validates the framed events of a run, writes the rejected ones to the reject file and keeps
+    per-channel counters of the errors, indexed by the value of the channel field. Framing errors
+    that cannot be attributed to an event, like words lost between two events, are counted in
+    unattributed_framing.
+
+    The CRC is checked only with check_crc. Its definition is not negotiated with the front-end:
+    if most of the first events fail the CRC check, the CRC is not checked for the rest of the run.
+    The reject file is created with the first rejected event.
+    """
+
+    def __init__(self, reject_path=None, n_channels=N_CHANNELS, policy=None, check_crc=CHECK_CRC):
+        self.n_channels = n_channels
+        self.reject_path = reject_path
+        self.policy = policy
+        self.writer = None
+        # None until the first events decide, False when the CRC is not checked
+        self.check_crc = None if check_crc else False
+        self.crc_errors = np.zeros(CHANNEL_VALUES, dtype=np.int64)
+        self.framing_errors = np.zeros(CHANNEL_VALUES, dtype=np.int64)
+        self.out_of_range = np.zeros(CHANNEL_VALUES, dtype=np.int64)
+        self.unattributed_framing = 0
+
+    def decide_crc(self, words):
+        """Decides on the first events whether the CRC check can reject events. Returns the decision"""
+        if self.check_crc is None and len(words):
+            mismatch = crc_mismatch(words)
+            self.check_crc = bool(np.count_nonzero(mismatch) <= CRC_MAX_MISMATCH * len(words))
+            if not self.check_crc:
+                logger.error(f"{np.count_nonzero(mismatch)} of the first {len(words)} events fail the CRC check: "
+                             f"the CRC definition (polynomial 0x{CRC_POLY:02x}) does not match the front-end. The CRC is not checked in this run")
+        return self.check_crc is not False
+
+    def validate(self, words, framing_rejects=None):
+        """Validates an (N, 8) array of framed events and records the rejected ones. Returns the valid events"""
+        words, rejects = validate_words(words, self.n_channels, self.decide_crc(words), framing_rejects)
+        self.record(rejects)
+        return words
+
+    def record(self, rejects):
+        if not len(rejects):
+            return
+        channel = (rejects["words"][:, 1] >> 8) & 0x1F
+        reason = rejects["reason"]
+        self.crc_errors += np.bincount(channel[(reason & REJECT_CRC) != 0], minlength=CHANNEL_VALUES)
+        self.framing_errors += np.bincount(channel[(reason & REJECT_FRAMING) != 0], minlength=CHANNEL_VALUES)
+        self.out_of_range += np.bincount(channel[(reason & REJECT_CHANNEL) != 0], minlength=CHANNEL_VALUES)
+        if self.reject_path:
+            if not self.writer:
+                self.writer = RejectWriter(self.reject_path, self.policy)
+            self.writer.write(rejects)
+
+    def tick(self):
+        if self.writer:
+            self.writer.tick()
+
+    def close(self, unattributed_framing=0):
+        """Closes the reject file and returns the counters of the run"""
+        self.unattributed_framing += unattributed_framing
+        if self.writer:
+            self.writer.close()
+        stats = {
+            "crc_errors": self.crc_errors[:self.n_channels].tolist(),
+            "framing_errors": self.framing_errors[:self.n_channels].tolist(),
+            "out_of_range": {channel: int(self.out_of_range[channel]) for channel in np.flatnonzero(self.out_of_range).tolist()},
+            "unattributed_framing": self.unattributed_framing,
+            "crc_checked": bool(self.check_crc),
+        }
+        rejected = int(self.crc_errors.sum() + self.framing_errors.sum() + self.out_of_range.sum())
+        if rejected or self.unattributed_framing:
+            logger.warning(f"Rejected events: CRC errors per channel {stats['crc_errors']}, framing errors per channel "
+                           f"{stats['framing_errors']}, out of range channels {stats['out_of_range']}, "
+                           f"{self.unattributed_framing} unattributed framing errors")
+        return stats
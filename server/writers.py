@@ -0,0 +1,252 @@
+import argparse
+import csv
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+
+from decoder import EVENT_DTYPE, TDC_BINS, TimestampUnwrapper
+
+
+logger = logging.getLogger("DataProcessing")
+
+# Column names of the CSV acquisition files
+CSV_HEADER = ["Channel", "Unix_time_16_bit", "Coarse_time", "TDC_time", "ToT_time", "TDC_trigger_end", "Energy", "CRC", "Timestamp"]
+# Acquisitions saved before the timestamp reconstruction have no Timestamp column
+LEGACY_CSV_HEADER = CSV_HEADER[:-1]
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# Width reserved for the number of events in the .npy header, so that it can be rewritten in place
+NPY_SHAPE_WIDTH = 20
+
+
+class FlushPolicy:
+    """
+    Decides when the events buffered by an EventWriter are written to disk.
+
+    Parameters:
+        max_events (int): Flush when this many events are buffered. None disables the size trigger.
+        interval (float): Flush when this many seconds have passed since the last flush. None disables the time trigger.
+        fsync (bool): Also ask the OS to commit the data to the disk at every flush.
+
+    With both triggers disabled the events are written only at the end of the run.
+    """
+
+    def __init__(self, max_events=100_000, interval=1.0, fsync=False):
+        self.max_events = max_events
+        self.interval = interval
+        self.fsync = fsync
+
+    def should_flush(self, pending_events, last_flush):
+        if self.max_events is not None and pending_events >= self.max_events:
+            return True
+        if self.interval is not None and pending_events and time.monotonic() - last_flush >= self.interval:
+            return True
+        return False
+
+    def __repr__(self):
+        return f"FlushPolicy(max_events={self.max_events}, interval={self.interval}, fsync={self.fsync})"
+
+
+# Flush policies selectable by name for an acquisition
+flush_policies = {
+    "size": FlushPolicy(max_events=100_000, interval=None),
+    "time": FlushPolicy(max_events=None, interval=1.0),
+    "end": FlushPolicy(max_events=None, interval=None),
+}
+
+
+class EventWriter:
+    """
+    Base class of the output backends used to store the decoded events of an acquisition.
+    Events are received as EVENT_DTYPE record arrays, one block at a time, and are kept in memory
+    until the flush policy asks to write them: a crash loses at most the events received since
+    the last flush.
+    """
+
+    extension = ""
+
+    def __init__(self, path, policy=None):
+        self.path = Path(path)
+        self.policy = policy or FlushPolicy()
+        self.events_written = 0
+        self.flushes = 0
+        self.pending = []
+        self.pending_events = 0
+        self.last_flush = time.monotonic()
+        self.file = None
+
+    def write(self, events):
+        if len(events):
+            self.pending.append(events)
+            self.pending_events += len(events)
+        self.tick()
+
+    def tick(self):
+        """Flushes the buffered events if the policy requires it. To be called periodically also without new data"""
+        if self.policy.should_flush(self.pending_events, self.last_flush):
+            self.flush()
+
+    def _write_block(self, events):
+        raise NotImplementedError
+
+    def _sync(self):
+        self.file.flush()
+
+    def flush(self):
+        if not self.file:
+            return
+        if self.pending:
+            events = self.pending[0] if len(self.pending) == 1 else np.concatenate(self.pending)
+            self._write_block(events)
+            self.events_written += len(events)
+            self.pending.clear()
+            self.pending_events = 0
+        self._sync()
+        if self.policy.fsync:
+            os.fsync(self.file.fileno())
+        self.flushes += 1
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+            logger.debug(f"{self.events_written} events written in {self.path} with {self.flushes} flushes")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NpyEventWriter(EventWriter):
+    """
+    Stores the events as a structured NumPy array in a .npy file, appended in binary blocks.
+    The header is rewritten with the number of events at every flush, so the file can always
+    be opened with np.load (also with mmap_mode="r").
+    """
+
+    extension = "npy"
+    dtype = EVENT_DTYPE
+
+    def __init__(self, path, policy=None):
+        super().__init__(path, policy)
+        self.file = open(self.path, "wb")
+        self.file.write(self._header(0))
+
+    @classmethod
+    def _header(cls, count):
+        descr = np.lib.format.dtype_to_descr(cls.dtype)
+        header = f"{{'descr': {descr!r}, 'fortran_order': False, 'shape': ({count:>{NPY_SHAPE_WIDTH}d},), }}"
+        # Magic string, header length and header have to be aligned to 64 bytes
+        padding = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+        header = header + " " * padding + "\n"
+        return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+    def _write_block(self, events):
+        self.file.write(np.ascontiguousarray(events, dtype=self.dtype).tobytes())
+
+    def _sync(self):
+        # The data has to reach the file before the header that accounts for it
+        self.file.flush()
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(self._header(self.events_written))
+        self.file.seek(position)
+        self.file.flush()
+
+
+class CSVEventWriter(EventWriter):
+    """Stores the events as text rows in a CSV file, as the acquisitions have always been saved"""
+
+    extension = "csv"
+
+    def __init__(self, path, policy=None, mode="a"):
+        super().__init__(path, policy)
+        self.file = open(self.path, mode, newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(CSV_HEADER)
+
+    def _write_block(self, events):
+        self.writer.writerows(events.tolist())
+
+
+# Output backends selectable for an acquisition => "backend_name" : writer class
+output_backends = {
+    "npy": NpyEventWriter,
+    "csv": CSVEventWriter,
+}
+
+
+def get_writer_class(backend):
+    try:
+        return output_backends[backend]
+    except KeyError:
+        raise ValueError(f"Unknown output backend '{backend}'. Available backends: {list(output_backends)}")
+
+
+def read_events(path):
+    """Returns the events stored in a .npy acquisition file as a read-only memory map"""
+    return np.load(path, mmap_mode="r")
+
+
+def export_csv(npy_path, csv_path=None, chunk_size=1_000_000):
+    """
+    Exports a .npy acquisition file to the CSV format, working in chunks to limit memory usage.
+    Returns the path of the CSV file.
+    """
+    npy_path = Path(npy_path)
+    csv_path = Path(csv_path) if csv_path else npy_path.with_suffix(".csv")
+    events = read_events(npy_path)
+    with CSVEventWriter(csv_path, FlushPolicy(max_events=chunk_size, interval=None), mode="w") as writer:
+        for start in range(0, len(events), chunk_size):
+            writer.write(np.asarray(events[start:start + chunk_size]))
+    logger.info(f"Exported {len(events)} events from {npy_path} to {csv_path}")
+    return csv_path
+
+
+def import_csv(csv_path, npy_path=None, chunk_size=1_000_000):
+    """
+    Converts a CSV acquisition file, as written before the .npy backend, to the .npy format.
+    The timestamps of CSV files without a Timestamp column are rebuilt anchoring them to the
+    modification time of the file. Returns the path of the .npy file.
+    """
+    csv_path = Path(csv_path)
+    npy_path = Path(npy_path) if npy_path else csv_path.with_suffix(".npy")
+    with open(csv_path, newline="") as file, NpyEventWriter(npy_path, FlushPolicy(max_events=chunk_size, interval=None)) as writer:
+        header = file.readline().strip().split(",")
+        if header == LEGACY_CSV_HEADER:
+            unwrapper = TimestampUnwrapper(csv_path.stat().st_mtime)
+        elif header == CSV_HEADER:
+            unwrapper = None
+        else:
+            raise ValueError(f"Unexpected CSV header in {csv_path}: {header}")
+        while True:
+            rows = np.loadtxt(file, delimiter=",", dtype=np.uint64, max_rows=chunk_size, ndmin=2)
+            if not len(rows):
+                break
+            events = np.zeros(len(rows), dtype=EVENT_DTYPE)
+            for column, name in enumerate(EVENT_DTYPE.names[:len(header)]):
+                events[name] = rows[:, column]
+            if unwrapper:
+                events["timestamp"] = events["coarse_time"].astype(np.uint64) * TDC_BINS + events["tdc_time"]
+                unwrapper.apply(events)
+            writer.write(events)
+            if len(rows) < chunk_size:
+                break
+    logger.info(f"Imported {writer.events_written} events from {csv_path} to {npy_path}")
+    return npy_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export .npy acquisition files to CSV")
+    parser.add_argument("files", nargs="+", help="The .npy acquisition files to export")
+    args = parser.parse_args()
+    for fname in args.files:
+        print(export_csv(fname))